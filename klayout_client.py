@@ -0,0 +1,420 @@
+"""Blocking and asyncio clients for the KLayout JSON TCP server.
+
+Both clients keep one connection open, tag every request with a fresh id and
+match replies by id, so several requests can be in flight on one socket.
+Push events (``{"event": ...}`` lines such as selection changes) are kept
+apart from RPC replies and delivered to ``on_event`` or a bounded event queue
+that drops the oldest events once nobody reads it.
+Pass ``path`` to talk to the server's local-socket listener instead of TCP.
+
+Large results requested with ``"shm": true`` arrive as a shared-memory
+handle; ``open_shared`` maps them without copying:
+
+    result = client.call("layer_polygons", {"layer": "1/0", "shm": True})
+    buffer = client.open_shared(result)
+    coords, offsets = buffer["coords"], buffer["offsets"]
+    ...
+    client.release_shared(buffer)
+
+    with KlayoutClient() as client:
+        cells = client.call("get_cell_list")["cells"]
+        replies = client.pipeline([("ping", {}), ("get_cell_list", {})])
+
+    async with AsyncKlayoutClient() as client:
+        await client.call("subscribe_selection")
+        async for event in client.events():
+            ...
+"""
+
+import asyncio
+import base64
+import collections
+import itertools
+import json
+import mmap
+import socket
+import struct
+
+try:
+    import numpy
+except ImportError:  # shared arrays then come back as memoryviews
+    numpy = None
+
+
+HOST = "127.0.0.1"
+PORT = 9009
+RECV_SIZE = 1 << 16
+# Upper bound for one reply line (large cell lists / geometry).
+MAX_LINE_BYTES = 1 << 26
+# Push events kept for a caller that is not reading them; the oldest go first.
+MAX_QUEUED_EVENTS = 1024
+
+
+class KlayoutError(RuntimeError):
+    """The server answered with ``"ok": false``."""
+
+    def __init__(self, response):
+        super().__init__(response.get("error") or "KLayout error")
+        self.response = response
+
+
+_MEMORYVIEW_FORMATS = {"uint8": "B", "int32": "i", "int64": "q", "float32": "f", "float64": "d"}
+
+
+class SharedBuffer:
+    """Read-only mapping of a result the server placed in shared memory.
+
+    ``buffer[name]`` is a NumPy array (a memoryview without NumPy) backed
+    directly by the mapping, in the server's native byte order.
+    """
+
+    def __init__(self, descriptor):
+        self.handle = descriptor["handle"]
+        self.path = descriptor["path"]
+        self.specs = descriptor["arrays"]
+        with open(self.path, "rb") as handle:
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        self._arrays = {}
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = self._view(self.specs[name])
+        return self._arrays[name]
+
+    def keys(self):
+        return self.specs.keys()
+
+    def _view(self, spec):
+        shape = tuple(spec["shape"])
+        count = 1
+        for size in shape:
+            count *= size
+        if numpy is not None:
+            return numpy.frombuffer(
+                self._map, dtype=spec["dtype"], count=count, offset=spec["offset"]
+            ).reshape(shape)
+        fmt = _MEMORYVIEW_FORMATS[spec["dtype"]]
+        start = spec["offset"]
+        view = memoryview(self._map)[start : start + count * struct.calcsize(fmt)]
+        # memoryview cannot carry a shape with zeros in it.
+        return view.cast(fmt, shape) if count else view.cast(fmt)
+
+    def close(self):
+        self._arrays = {}
+        try:
+            self._map.close()
+        except BufferError:
+            # Arrays handed out earlier still point into the mapping.
+            pass
+
+
+def unpack_array(result):
+    """Array from a reply with base64 little-endian "data", "dtype" and "shape"."""
+    raw = base64.b64decode(result["data"])
+    shape = tuple(result["shape"])
+    if numpy is not None:
+        dtype = numpy.dtype(result["dtype"]).newbyteorder("<")
+        return numpy.frombuffer(raw, dtype=dtype).reshape(shape)
+    view = memoryview(raw).cast(_MEMORYVIEW_FORMATS[result["dtype"]])
+    return view.cast("B").cast(view.format, shape) if len(view) else view
+
+
+def _encode(req_id, method, params, trace=None):
+    payload = {"id": req_id, "method": method, "params": params or {}}
+    if trace:
+        # {"trace_id": ..., "span_id": ...}; the server echoes its own timings.
+        payload["trace"] = trace
+    return json.dumps(payload).encode("utf-8") + b"\n"
+
+
+def _result(response):
+    if not response.get("ok"):
+        raise KlayoutError(response)
+    return response.get("result")
+
+
+class KlayoutClient:
+    """Blocking client with connection reuse and pipelining."""
+
+    def __init__(self, host=HOST, port=PORT, timeout=5.0, on_event=None, path=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.on_event = on_event
+        self._sock = None
+        self._ids = itertools.count(1)
+        self._buffer = bytearray()
+        self._scan = 0
+        self._replies = {}
+        # Ids still awaited; replies to anything else (timed out) are dropped.
+        self._outstanding = set()
+        self._events = collections.deque(maxlen=MAX_QUEUED_EVENTS)
+        self.events_dropped = 0
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        if self._sock is None:
+            if self.path:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.timeout)
+                try:
+                    sock.connect(self.path)
+                except OSError:
+                    sock.close()
+                    raise
+                self._sock = sock
+            else:
+                self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        return self
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            finally:
+                self._sock = None
+                self._buffer = bytearray()
+                self._scan = 0
+                self._replies = {}
+                self._outstanding = set()
+
+    def send(self, method, params=None, trace=None):
+        """Write one request without waiting; return its id."""
+        req_id = next(self._ids)
+        self.connect()
+        self._sock.sendall(_encode(req_id, method, params, trace))
+        self._outstanding.add(req_id)
+        return req_id
+
+    def wait(self, req_id, timeout=None):
+        """Return the raw reply dict for ``req_id``."""
+        try:
+            while req_id not in self._replies:
+                message = self._read_message(timeout)
+                if message is None:
+                    raise ConnectionError("No response from KLayout")
+        finally:
+            self._outstanding.discard(req_id)
+        return self._replies.pop(req_id)
+
+    def request(self, method, params=None, timeout=None, trace=None):
+        return self.wait(self.send(method, params, trace), timeout)
+
+    def call(self, method, params=None, timeout=None):
+        """Return the ``result`` of a call, raising KlayoutError on failure."""
+        return _result(self.request(method, params, timeout))
+
+    def pipeline(self, requests, timeout=None):
+        """Send all ``(method, params)`` pairs in one write, return replies in order."""
+        ids = []
+        lines = []
+        for method, params in requests:
+            req_id = next(self._ids)
+            ids.append(req_id)
+            lines.append(_encode(req_id, method, params))
+        self.connect()
+        self._sock.sendall(b"".join(lines))
+        self._outstanding.update(ids)
+        try:
+            return [self.wait(req_id, timeout) for req_id in ids]
+        finally:
+            for req_id in ids:
+                self._outstanding.discard(req_id)
+                self._replies.pop(req_id, None)
+
+    def open_shared(self, result):
+        """Map the shared arrays of a ``"shm": true`` result."""
+        return SharedBuffer(result.get("shared", result))
+
+    def release_shared(self, buffer):
+        """Unmap ``buffer`` and let the server delete it."""
+        buffer.close()
+        return self.call("release_buffer", {"handle": buffer.handle})
+
+    def next_event(self, timeout=None):
+        """Return the next push event, or None if none arrived within ``timeout``."""
+        while not self._events:
+            try:
+                message = self._read_message(timeout)
+            except socket.timeout:
+                return None
+            if message is None:
+                return None
+        return self._events.popleft()
+
+    def _read_message(self, timeout=None):
+        """Read and route one line; return it, or None on EOF."""
+        self.connect()
+        self._sock.settimeout(self.timeout if timeout is None else timeout)
+        while True:
+            idx = self._buffer.find(b"\n", self._scan)
+            if idx >= 0:
+                line = bytes(self._buffer[:idx])
+                del self._buffer[: idx + 1]
+                self._scan = 0
+                if not line.strip():
+                    continue
+                message = json.loads(line.decode("utf-8"))
+                self._route(message)
+                return message
+            self._scan = len(self._buffer)
+            if self._scan > MAX_LINE_BYTES:
+                raise ConnectionError("KLayout reply exceeds %d bytes" % MAX_LINE_BYTES)
+            chunk = self._sock.recv(RECV_SIZE)
+            if not chunk:
+                self.close()
+                return None
+            self._buffer += chunk
+
+    def _route(self, message):
+        if "event" in message and "id" not in message:
+            if self.on_event is not None:
+                self.on_event(message)
+            else:
+                if len(self._events) == self._events.maxlen:
+                    self.events_dropped += 1
+                self._events.append(message)
+            return
+        if message.get("id") in self._outstanding:
+            self._replies[message.get("id")] = message
+
+
+class AsyncKlayoutClient:
+    """asyncio client; concurrent calls share one pipelined connection."""
+
+    def __init__(self, host=HOST, port=PORT, timeout=5.0, on_event=None, path=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.on_event = on_event
+        self._ids = itertools.count(1)
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._loop = None
+        self._pending = {}
+        self._events = None
+        self.events_dropped = 0
+        self._connect_lock = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Streams are bound to the loop that created them.
+            self._drop(ConnectionError("event loop changed"))
+            self._loop = loop
+            self._connect_lock = asyncio.Lock()
+            self._events = asyncio.Queue(MAX_QUEUED_EVENTS)
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return self
+            if self.path:
+                opening = asyncio.open_unix_connection(self.path, limit=MAX_LINE_BYTES)
+            else:
+                opening = asyncio.open_connection(self.host, self.port, limit=MAX_LINE_BYTES)
+            self._reader, self._writer = await asyncio.wait_for(opening, self.timeout)
+            self._reader_task = loop.create_task(self._read_loop(self._reader))
+        return self
+
+    async def close(self):
+        writer = self._writer
+        self._drop(ConnectionError("client closed"))
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def request(self, method, params=None, timeout=None, trace=None):
+        """Return the raw reply dict."""
+        await self.connect()
+        req_id = next(self._ids)
+        future = self._loop.create_future()
+        self._pending[req_id] = future
+        try:
+            self._writer.write(_encode(req_id, method, params, trace))
+            await self._writer.drain()
+            return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        finally:
+            self._pending.pop(req_id, None)
+
+    async def call(self, method, params=None, timeout=None):
+        return _result(await self.request(method, params, timeout))
+
+    async def pipeline(self, requests, timeout=None):
+        return await asyncio.gather(
+            *(self.request(method, params, timeout) for method, params in requests)
+        )
+
+    def open_shared(self, result):
+        return SharedBuffer(result.get("shared", result))
+
+    async def release_shared(self, buffer):
+        buffer.close()
+        return await self.call("release_buffer", {"handle": buffer.handle})
+
+    async def events(self):
+        """Async iterator over push events (used when no ``on_event`` is set)."""
+        await self.connect()
+        while True:
+            yield await self._events.get()
+
+    async def _read_loop(self, reader):
+        error = ConnectionError("KLayout closed the connection")
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                message = json.loads(line.decode("utf-8"))
+                if "event" in message and "id" not in message:
+                    if self.on_event is not None:
+                        self.on_event(message)
+                    else:
+                        if self._events.full():
+                            self._events.get_nowait()
+                            self.events_dropped += 1
+                        self._events.put_nowait(message)
+                    continue
+                future = self._pending.get(message.get("id"))
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except (OSError, ValueError, asyncio.LimitOverrunError) as exc:
+            error = ConnectionError("KLayout connection failed: %s" % exc)
+        finally:
+            if reader is self._reader:
+                self._drop(error)
+
+    def _drop(self, error):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending = {}
+        try:
+            if self._reader_task is not None and self._reader_task is not asyncio.current_task():
+                self._reader_task.cancel()
+            if self._writer is not None:
+                self._writer.close()
+        except RuntimeError:
+            # The previous event loop is already closed.
+            pass
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
@@ -0,0 +1,129 @@
+"""Record and replay upstream LLM streams and KLayout replies.
+
+A cassette is a JSON-lines file with one record per upstream stream and one
+per KLayout reply:
+
+    {"type": "llm", "complete": true, "frames": [[0.231, "<base64>"], ...]}
+    {"type": "klayout", "method": "get_cell_list", "params": {}, "elapsed": 0.004,
+     "response": {...}}
+
+Frame delays are seconds since the previous chunk (the first one since the
+request was sent), so a replay reproduces time-to-first-token and the
+inter-token gaps of real traffic. Replays run at ``speed`` times real time;
+``speed=0`` plays everything back as fast as possible.
+"""
+
+import asyncio
+import base64
+import collections
+import json
+import time
+
+
+class CassetteRecorder:
+    """Append streams and KLayout replies to a cassette file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _write(self, record):
+        with open(self.path, "a", encoding="utf-8") as handle:
+            handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    async def record_stream(self, chunks, started=None):
+        """Pass ``chunks`` through unchanged and write their timings once done."""
+        frames = []
+        last = time.monotonic() if started is None else started
+        complete = False
+        try:
+            async for chunk in chunks:
+                now = time.monotonic()
+                frames.append([round(now - last, 6), base64.b64encode(chunk).decode("ascii")])
+                last = now
+                yield chunk
+            complete = True
+        finally:
+            self._write({"type": "llm", "complete": complete, "frames": frames})
+
+    def record_klayout(self, method, params, response, elapsed):
+        self._write({
+            "type": "klayout",
+            "method": method,
+            "params": params or {},
+            "elapsed": round(elapsed, 6),
+            "response": response,
+        })
+
+
+class RecordingKlayoutClient:
+    """Forwards requests to a real client and records each reply."""
+
+    def __init__(self, client, recorder):
+        self._client = client
+        self._recorder = recorder
+
+    async def request(self, method, params=None, timeout=None, trace=None):
+        started = time.monotonic()
+        response = await self._client.request(method, params, timeout, trace=trace)
+        self._recorder.record_klayout(method, params, response, time.monotonic() - started)
+        return response
+
+
+def _params_key(method, params):
+    return method, json.dumps(params or {}, sort_keys=True)
+
+
+class CassettePlayer:
+    """Serves recorded streams and KLayout replies without any upstream.
+
+    Streams are handed out in recorded order and wrap around, so a short
+    cassette can drive a long benchmark. KLayout replies are matched by
+    method and params, in recorded order per key, falling back to the last
+    reply recorded for the method.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.speed = float(speed)
+        self._streams = []
+        self._replies = collections.defaultdict(collections.deque)
+        self._by_method = {}
+        self._next_stream = 0
+        with open(path, "r", encoding="utf-8") as handle:
+            for line in handle:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("type") == "llm":
+                    self._streams.append([
+                        (delay, base64.b64decode(data)) for delay, data in record["frames"]
+                    ])
+                elif record.get("type") == "klayout":
+                    self._replies[_params_key(record["method"], record.get("params"))].append(record)
+                    self._by_method[record["method"]] = record
+        if not self._streams:
+            raise ValueError("Cassette %s holds no LLM streams" % path)
+
+    async def _pause(self, seconds):
+        if self.speed > 0 and seconds > 0:
+            await asyncio.sleep(seconds / self.speed)
+
+    async def stream(self):
+        """Yield the chunks of the next recorded stream with their original pacing."""
+        frames = self._streams[self._next_stream % len(self._streams)]
+        self._next_stream += 1
+        for delay, chunk in frames:
+            await self._pause(delay)
+            yield chunk
+
+    async def request(self, method, params=None, timeout=None, trace=None):
+        """Drop-in for ``AsyncKlayoutClient.request`` answering from the cassette."""
+        queue = self._replies.get(_params_key(method, params))
+        if queue:
+            record = queue[0]
+            queue.rotate(-1)
+        else:
+            record = self._by_method.get(method)
+        if record is None:
+            return {"id": None, "ok": False, "error": "No recorded reply for %s" % method}
+        await self._pause(record.get("elapsed", 0.0))
+        return json.loads(json.dumps(record["response"]))
@@ -1,23 +1,82 @@
+import asyncio
+import base64
+import collections
+import itertools
 import json
+import multiprocessing
 import os
-import socket
+import sys
+import time
+import uuid
 
 import httpx
 from fastapi import FastAPI, Request
 from starlette.responses import StreamingResponse
 
+from klayout_client import AsyncKlayoutClient, KlayoutClient
+from llm_cassette import CassettePlayer, CassetteRecorder, RecordingKlayoutClient
+
 
 KLAYOUT_HOST = "127.0.0.1"
 KLAYOUT_PORT = 9009
+KLAYOUT_TIMEOUT = 3.0
+# Local-socket path of the KLayout server; when set it is used instead of TCP.
+KLAYOUT_SOCKET_PATH = os.environ.get("KLAYOUT_LOCAL_SOCKET") or None
 KLAYOUT_TOOL_NAME = "klayout"
 LLM_ENDPOINT = "http://127.0.0.1:1234/v1/chat/completions"
 LLM_MODEL = "qwen/qwen3-coder-30b"
 LOG_PATH = './llm.log'
 PROXY_PORT = 8001
+# Upstream chunks buffered for a slow client before the upstream read pauses.
+STREAM_QUEUE_CHUNKS = 64
+# Methods whose results depend only on params and the layout generation.
+KLAYOUT_READ_ONLY_METHODS = {"ping", "get_cell_list", "cell_tree", "pick", "shapes_touching"}
+# Methods that change the layout and invalidate cached results.
+KLAYOUT_MUTATING_METHODS = {"open_layout", "load_gds"}
+# Methods that start push events; nothing on the proxy's shared connection
+# would ever consume them, so tool calls naming these are refused.
+KLAYOUT_SUBSCRIBE_METHODS = {"subscribe_selection", "subscribe_layout_changes"}
+KLAYOUT_CACHE_SIZE = 256
+KLAYOUT_CACHE_TTL = 30.0
+# Spans (one trace per /chat/completions request) as OTLP-shaped JSON lines;
+# off unless LLM_TRACE_PATH names a file.
+TRACE_PATH = os.environ.get("LLM_TRACE_PATH") or None
+# "record" tees upstream streams and KLayout replies into CASSETTE_PATH;
+# "replay" serves them back with no LLM or KLayout running.
+CASSETTE_MODE = os.environ.get("LLM_CASSETTE_MODE", "")
+CASSETTE_PATH = os.environ.get("LLM_CASSETTE_PATH", "./cassette.jsonl")
+# Replay pacing: 1 = recorded timings, 10 = ten times faster, 0 = no delays.
+REPLAY_SPEED = float(os.environ.get("LLM_REPLAY_SPEED", "1"))
+# Pool of OpenAI-compatible upstreams: a JSON list (or a path to a JSON file)
+# like [{"url": "http://box1:1234/v1/chat/completions", "weight": 2,
+#        "models": {"qwen/qwen3-coder-30b": "qwen3-coder-30b-a3b"}}].
+# Unset means LLM_ENDPOINT alone.
+LLM_UPSTREAMS = os.environ.get("LLM_UPSTREAMS", "")
+UPSTREAM_HEALTH_INTERVAL = 10.0
+UPSTREAM_HEALTH_TIMEOUT = 2.0
+# Consecutive failures after which an upstream is ejected, and for how long.
+UPSTREAM_MAX_FAILURES = 2
+UPSTREAM_EJECT_SECONDS = 30.0
+# Uvicorn worker processes; above 1, logging and KLayout dispatch move into
+# one sidecar process that the workers reach over SIDECAR_PATH.
+PROXY_WORKERS = int(os.environ.get("LLM_PROXY_WORKERS", "1"))
+SIDECAR_PATH = os.path.abspath(os.environ.get("LLM_SIDECAR_PATH", "./llm_sidecar.sock"))
+SIDECAR_MAX_LINE_BYTES = 1 << 26
+# Lines a worker holds while the sidecar is unreachable; the oldest go first.
+SIDECAR_BACKLOG_LINES = 10000
+# Unsent bytes a worker lets pile up for a stalled sidecar before it drops
+# log lines (commands are always sent).
+SIDECAR_WRITE_BUFFER_BYTES = 16 << 20
+# Set by __main__ for worker processes only.
+SIDECAR_SOCKET = os.environ.get("LLM_SIDECAR_SOCKET", "")
 
 class AppLogger:
-    def __init__(self, log_file="llm.log"):
+    def __init__(self, log_file="llm.log", truncate=True):
         self.log_file = log_file
+        if truncate:
+            self.truncate()
+
+    def truncate(self):
         with open(self.log_file, "w", encoding="utf-8") as handle:
             handle.write("")
 
@@ -26,39 +85,516 @@ class AppLogger:
             handle.write(message + "\n")
         print(message)
 
+    def log_bytes(self, data):
+        """Append already-encoded UTF-8 bytes verbatim (no decode/re-encode)."""
+        with open(self.log_file, "ab") as handle:
+            handle.write(data)
+        try:
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+        except (AttributeError, ValueError):
+            print(data.decode("utf-8", errors="replace"), end="")
+
+
+class _Span:
+    """One timed operation of a request trace, written to TRACE_PATH on end()."""
+
+    def __init__(self, name, parent=None, kind="INTERNAL", **attributes):
+        self.name = name
+        self.kind = kind
+        # The parent is a span, or the context() of one from another process.
+        context = parent.context() if isinstance(parent, _Span) else parent
+        self.trace_id = context["trace_id"] if context else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = context["span_id"] if context else None
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+
+    def child(self, name, kind="INTERNAL", **attributes):
+        return _Span(name, self, kind, **attributes)
+
+    def context(self):
+        """The trace context carried in KLayout payloads."""
+        return {"trace_id": self.trace_id, "span_id": self.span_id}
+
+    def end(self, error=None):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        record = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "attributes": self.attributes,
+            "status": {"code": "ERROR", "message": str(error)} if error else {"code": "OK"},
+            "resource": {"service.name": "llm-klayout-proxy"},
+        }
+        if not TRACE_PATH:
+            return
+        try:
+            with open(TRACE_PATH, "a", encoding="utf-8") as handle:
+                handle.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except OSError:
+            pass
+
+
+def _span_child(span, name, kind="INTERNAL", **attributes):
+    return _Span(name, span, kind, **attributes) if span is not None else None
+
+
+def _span_end(span, error=None):
+    if span is not None:
+        span.end(error)
+
+
+_klayout = AsyncKlayoutClient(
+    KLAYOUT_HOST, KLAYOUT_PORT, timeout=KLAYOUT_TIMEOUT, path=KLAYOUT_SOCKET_PATH
+)
+_cassette = None
+if CASSETTE_MODE == "record":
+    _cassette = CassetteRecorder(CASSETTE_PATH)
+    _klayout = RecordingKlayoutClient(_klayout, _cassette)
+elif CASSETTE_MODE == "replay":
+    _cassette = CassettePlayer(CASSETTE_PATH, REPLAY_SPEED)
+    _klayout = _cassette
+elif CASSETTE_MODE:
+    raise ValueError("LLM_CASSETTE_MODE must be 'record' or 'replay', not %r" % CASSETTE_MODE)
+
+
+def _log_klayout_response(response, logger):
+    logger.log("[KLAYOUT] response: %s" % json.dumps(response))
+
 
 def _send_klayout_command(command, logger):
     method = command.get("method")
     if not method:
         return
-    payload = {
-        "id": command.get("id", 1),
-        "method": method,
-        "params": command.get("params", {}),
-    }
     try:
-        sock = socket.create_connection((KLAYOUT_HOST, KLAYOUT_PORT), timeout=3)
+        with KlayoutClient(
+            KLAYOUT_HOST, KLAYOUT_PORT, timeout=KLAYOUT_TIMEOUT, path=KLAYOUT_SOCKET_PATH
+        ) as client:
+            response = client.request(method, command.get("params", {}))
     except OSError as exc:
-        logger.log("[KLAYOUT] connect error: %s" % exc)
+        logger.log("[KLAYOUT] request error: %s" % exc)
         return
-    try:
-        line = json.dumps(payload).encode("utf-8") + b"\n"
-        sock.sendall(line)
-        data = b""
-        while b"\n" not in data:
-            chunk = sock.recv(4096)
-            if not chunk:
+    _log_klayout_response(response, logger)
+
+
+def _response_ok(response):
+    return bool(response.get("ok"))
+
+
+def _response_cacheable(response):
+    """OK replies, except shared-memory handles the server deletes on release."""
+    if not _response_ok(response):
+        return False
+    result = response.get("result")
+    return not (isinstance(result, dict) and "shared" in result)
+
+
+class _KlayoutResultCache:
+    """LRU cache of read-only KLayout responses with in-flight request coalescing.
+
+    Keys include the server's layout generation, so entries for an older
+    layout are simply never hit again; mutating methods clear everything.
+    """
+
+    def __init__(self, max_entries=KLAYOUT_CACHE_SIZE, ttl=KLAYOUT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._inflight = {}
+
+    def invalidate(self):
+        self._entries.clear()
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        stored_at, response = entry
+        if time.monotonic() - stored_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    def _put(self, key, response):
+        self._entries[key] = (time.monotonic(), response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def fetch(self, key, loader):
+        """Return (response, shared); shared is True for cache hits and merged calls."""
+        while True:
+            response = self._get(key)
+            if response is not None:
+                return response, True
+            future = self._inflight.get(key)
+            if future is None:
                 break
-            data += chunk
-        if data:
-            response = data.split(b"\n", 1)[0].decode("utf-8")
-            logger.log("[KLAYOUT] response: %s" % response)
-        else:
-            logger.log("[KLAYOUT] empty response")
+            response = await asyncio.shield(future)
+            if response is not None:
+                return response, True
+            # The caller that was loading it got cancelled; load it ourselves.
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            response = await loader()
+        except asyncio.CancelledError:
+            # Only this caller went away; merged callers must not see that.
+            future.set_result(None)
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        # Server timings belong to this call only, not to later hits.
+        stored = {name: value for name, value in response.items() if name != "trace"}
+        if _response_cacheable(response):
+            self._put(key, stored)
+        future.set_result(stored)
+        return response, False
+
+
+_klayout_cache = _KlayoutResultCache()
+# Work abandoned because the client went away (per process; see /stats).
+_CANCELLATIONS = collections.Counter(
+    client_disconnects=0, upstream_aborts=0, klayout_commands_cancelled=0
+)
+
+
+async def _klayout_generation(span=None):
+    try:
+        response = await _klayout.request(
+            "layout_generation", trace=span.context() if span else None
+        )
+    except OSError:
+        return None
+    if not response.get("ok"):
+        return None
+    return (response.get("result") or {}).get("generation")
+
+
+def _task_cancelled():
+    """True if the running task itself is being cancelled.
+
+    A CancelledError can also surface from something the task awaited
+    without anyone cancelling the task; that is an error, not a disconnect.
+    """
+    task = asyncio.current_task()
+    return task is not None and task.cancelling() > 0
+
+
+async def _dispatch_klayout_commands(commands, logger, span=None):
+    """Run independent read-only commands concurrently, anything else in order."""
+    done = 0
+
+    async def run(command):
+        nonlocal done
+        await _dispatch_klayout_command(command, logger, span)
+        done += 1
+
+    try:
+        if len(commands) > 1 and all(
+            command.get("method") in KLAYOUT_READ_ONLY_METHODS for command in commands
+        ):
+            await asyncio.gather(*(run(command) for command in commands))
+            return
+        for command in commands:
+            await run(command)
+    except asyncio.CancelledError:
+        # Commands not sent yet are dropped; replies to sent ones are ignored.
+        if _task_cancelled():
+            _CANCELLATIONS["klayout_commands_cancelled"] += len(commands) - done
+        raise
+
+
+async def _dispatch_klayout_command(command, logger, span=None):
+    method = command.get("method")
+    if not method:
+        return
+    if method in KLAYOUT_SUBSCRIBE_METHODS:
+        logger.log("[KLAYOUT] refused %s: push events are not available through the proxy" % method)
+        return
+    params = command.get("params", {})
+    call_span = _span_child(span, "klayout.%s" % method, "CLIENT", **{"rpc.method": method})
+    trace = call_span.context() if call_span else None
+    response = None
+    shared = False
+    error = None
+    try:
+        # A shared-memory handle is good for one reader only.
+        if method in KLAYOUT_READ_ONLY_METHODS and not (
+            isinstance(params, dict) and params.get("shm")
+        ):
+            generation = await _klayout_generation(call_span)
+            if generation is not None:
+                key = (method, json.dumps(params, sort_keys=True), generation)
+                response, shared = await _klayout_cache.fetch(
+                    key, lambda: _klayout.request(method, params, trace=trace)
+                )
+                if shared:
+                    logger.log("[KLAYOUT] cache hit: %s" % method)
+                if call_span:
+                    call_span.attributes["klayout.cache_hit"] = shared
+        if response is None:
+            response = await _klayout.request(method, params, trace=trace)
     except OSError as exc:
-        logger.log("[KLAYOUT] send error: %s" % exc)
+        logger.log("[KLAYOUT] request error: %s" % exc)
+        error = exc if str(exc) else type(exc).__name__
+        return
+    except BaseException as exc:
+        error = exc if str(exc) else type(exc).__name__
+        raise
     finally:
-        sock.close()
+        if method in KLAYOUT_MUTATING_METHODS:
+            _klayout_cache.invalidate()
+        if response is not None:
+            # Shared replies did no server work for this span.
+            if call_span and not shared:
+                _annotate_klayout_span(call_span, response)
+            if error is None and not _response_ok(response):
+                error = response.get("error")
+        _span_end(call_span, error)
+    _log_klayout_response(response, logger)
+
+
+def _annotate_klayout_span(span, response):
+    """Copy the server-side timings echoed in a traced reply onto the client span."""
+    timing = response.get("trace")
+    if not isinstance(timing, dict):
+        return
+    span.attributes["klayout.server_span_id"] = timing.get("span_id")
+    span.attributes["klayout.queue_ms"] = timing.get("queue_ms")
+    span.attributes["klayout.handle_ms"] = timing.get("handle_ms")
+
+
+class _SidecarClient:
+    """Worker-side link to the dispatch sidecar, used in place of AppLogger.
+
+    Log lines and KLayout commands share one Unix socket per worker, so the
+    sidecar writes them in the order this worker produced them. Lines logged
+    before the connection is up are held back (at most SIDECAR_BACKLOG_LINES)
+    and sent once it is; while the sidecar falls behind, log lines are dropped
+    once SIDECAR_WRITE_BUFFER_BYTES are waiting to be sent.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._ids = itertools.count(1)
+        self._loop = None
+        self._writer = None
+        self._pending = {}
+        self._backlog = collections.deque(maxlen=SIDECAR_BACKLOG_LINES)
+        self.backlog_dropped = 0
+        self._connect_lock = None
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._writer = None
+            self._connect_lock = asyncio.Lock()
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return self
+            reader, writer = await asyncio.open_unix_connection(
+                self.path, limit=SIDECAR_MAX_LINE_BYTES
+            )
+            self._writer = writer
+            loop.create_task(self._read_loop(reader, writer))
+            backlog = list(self._backlog)
+            self._backlog.clear()
+            if self.backlog_dropped:
+                backlog.insert(0, self._drop_notice())
+            writer.writelines(backlog)
+        return self
+
+    @staticmethod
+    def _encode(message):
+        return (json.dumps(message, ensure_ascii=False) + "\n").encode("utf-8")
+
+    def _drop_notice(self):
+        text = "[SIDECAR] dropped %d log lines while the sidecar was unreachable or behind"
+        line = self._encode({"op": "log", "text": text % self.backlog_dropped})
+        self.backlog_dropped = 0
+        return line
+
+    def _send(self, message, droppable=False):
+        line = self._encode(message)
+        if self._writer is None or self._writer.is_closing():
+            if len(self._backlog) == self._backlog.maxlen:
+                self.backlog_dropped += 1
+            self._backlog.append(line)
+        elif not droppable:
+            self._writer.write(line)
+        elif self._writer.transport.get_write_buffer_size() >= SIDECAR_WRITE_BUFFER_BYTES:
+            self.backlog_dropped += 1
+        else:
+            if self.backlog_dropped:
+                self._writer.write(self._drop_notice())
+            self._writer.write(line)
+
+    def log(self, message):
+        self._send({"op": "log", "text": message}, droppable=True)
+
+    def log_bytes(self, data):
+        self._send(
+            {"op": "log_bytes", "data": base64.b64encode(data).decode("ascii")}, droppable=True
+        )
+
+    async def _call(self, message):
+        await self.connect()
+        req_id = next(self._ids)
+        future = self._loop.create_future()
+        self._pending[req_id] = future
+        try:
+            self._send(dict(message, id=req_id))
+            await self._writer.drain()
+            reply = await future
+        except asyncio.CancelledError:
+            self._send({"op": "cancel", "id": req_id})
+            raise
+        finally:
+            self._pending.pop(req_id, None)
+        if not reply.get("ok"):
+            raise RuntimeError(reply.get("error") or "sidecar %s failed" % message["op"])
+        return reply
+
+    async def dispatch(self, commands, span=None):
+        """Have the sidecar run ``commands``; return once all replies are logged.
+
+        Cancelling this call cancels the commands the sidecar has not sent yet.
+        """
+        await self._call({
+            "op": "dispatch",
+            "commands": commands,
+            "trace": span.context() if span is not None else None,
+        })
+
+    async def stats(self):
+        return (await self._call({"op": "stats"})).get("stats") or {}
+
+    async def _read_loop(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line.decode("utf-8"))
+                future = self._pending.get(message.get("id"))
+                if future is not None and not future.done():
+                    future.set_result(message)
+        except (OSError, ValueError):
+            pass
+        finally:
+            writer.close()
+            if writer is self._writer:
+                self._writer = None
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("dispatch sidecar went away"))
+
+
+async def _dispatch(commands, span=None):
+    """Dispatch in this process, or through the sidecar when running as a worker."""
+    if _sidecar is None:
+        await _dispatch_klayout_commands(commands, logger, span)
+        return
+    try:
+        await _sidecar.dispatch(commands, span)
+    except (OSError, RuntimeError) as exc:
+        print("[SIDECAR] dispatch error: %s" % exc, file=sys.stderr)
+
+
+async def _handle_sidecar_connection(reader, writer, sink):
+    running = {}
+
+    def reply(message):
+        if not writer.is_closing():
+            writer.write((json.dumps(message) + "\n").encode("utf-8"))
+
+    async def run(message):
+        try:
+            await _dispatch_klayout_commands(
+                message.get("commands") or [], sink, message.get("trace")
+            )
+            reply({"id": message.get("id"), "ok": True})
+        except asyncio.CancelledError:
+            # A cancel op from the worker needs no reply; anything else does,
+            # or the worker waits for one forever.
+            if not _task_cancelled():
+                reply({"id": message.get("id"), "ok": False, "error": "dispatch was cancelled"})
+        except Exception as exc:
+            reply({"id": message.get("id"), "ok": False, "error": str(exc)})
+        finally:
+            running.pop(message.get("id"), None)
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            message = json.loads(line.decode("utf-8"))
+            op = message.get("op")
+            if op == "log":
+                sink.log(message.get("text", ""))
+            elif op == "log_bytes":
+                sink.log_bytes(base64.b64decode(message.get("data", "")))
+            elif op == "dispatch":
+                running[message.get("id")] = asyncio.ensure_future(run(message))
+            elif op == "cancel":
+                task = running.get(message.get("id"))
+                if task is not None:
+                    task.cancel()
+            elif op == "stats":
+                reply({"id": message.get("id"), "ok": True, "stats": dict(_CANCELLATIONS)})
+    except (OSError, ValueError) as exc:
+        print("[SIDECAR] connection error: %s" % exc, file=sys.stderr)
+    finally:
+        for task in list(running.values()):
+            task.cancel()
+        writer.close()
+
+
+async def _serve_sidecar(path):
+    sink = AppLogger(LOG_PATH, truncate=False)
+    if os.path.exists(path):
+        os.unlink(path)
+    server = await asyncio.start_unix_server(
+        lambda reader, writer: _handle_sidecar_connection(reader, writer, sink),
+        path,
+        limit=SIDECAR_MAX_LINE_BYTES,
+    )
+    async with server:
+        await server.serve_forever()
+
+
+def _run_sidecar(path):
+    asyncio.run(_serve_sidecar(path))
+
+
+def _start_sidecar(path, timeout=10.0):
+    """Fork the sidecar and wait until its socket accepts connections."""
+    if os.path.exists(path):
+        os.unlink(path)
+    process = multiprocessing.Process(target=_run_sidecar, args=(path,), daemon=True)
+    process.start()
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if not process.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError("Dispatch sidecar failed to start on %s" % path)
+        time.sleep(0.05)
+    return process
 
 
 def _try_parse_json(text, start):
@@ -119,6 +655,33 @@ def _extract_content_from_event(line):
         data = json.loads(payload)
     except json.JSONDecodeError:
         return ""
+    return _content_from_event_data(data)
+
+
+def _decode_sse_data(line):
+    """Decode one upstream SSE line (bytes) for the side path.
+
+    Only ``data:`` frames that can carry content or tool calls are parsed;
+    everything else returns None without touching the JSON decoder.
+    """
+    line = line.strip()
+    if not line.startswith(b"data:"):
+        return None
+    payload = line[5:].strip()
+    if payload == b"[DONE]":
+        return None
+    if b'"content"' not in payload and b'"tool_calls"' not in payload:
+        return None
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    return data
+
+
+def _content_from_event_data(data):
     choices = data.get("choices") or []
     if not choices:
         return ""
@@ -131,66 +694,385 @@ def _extract_content_from_event(line):
     content = message.get("content")
     if content is not None:
         return content
-    tool_calls = delta.get("tool_calls") or message.get("tool_calls") or []
-    if not tool_calls:
-        return ""
-    arguments = []
-    for tool_call in tool_calls:
-        function = tool_call.get("function") or {}
-        name = function.get("name")
-        args = function.get("arguments") or ""
-        if name:
-            trimmed = args.lstrip()
-            if trimmed.startswith("{"):
-                trimmed = trimmed[1:]
-            arguments.append(f'{{"tool":"{name}",{trimmed}')
-        elif args:
-            arguments.append(args)
-    return "".join(arguments)
+    return ""
+
+
+def _tool_call_to_command(name, arguments):
+    if name != KLAYOUT_TOOL_NAME:
+        return None
+    try:
+        args = json.loads(arguments) if arguments.strip() else {}
+    except ValueError:
+        return None
+    if not isinstance(args, dict) or not args.get("method"):
+        return None
+    command = dict(args)
+    command["tool"] = name
+    return command
+
+
+class _ToolCallAssembler:
+    """Accumulate OpenAI ``tool_calls`` deltas per index into KLayout commands.
+
+    A function named ``klayout`` whose arguments are ``{"method": ..., "params": ...}``
+    becomes the same command dict as a JSON tool block in the text.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def feed(self, data):
+        """Consume one event; return the commands completed by it."""
+        choices = data.get("choices") or []
+        if not choices:
+            return []
+        choice = choices[0]
+        delta = choice.get("delta") or {}
+        message = choice.get("message") or {}
+        tool_calls = delta.get("tool_calls") or message.get("tool_calls") or []
+        for position, tool_call in enumerate(tool_calls):
+            index = tool_call.get("index", position)
+            entry = self._calls.setdefault(index, {"name": "", "arguments": []})
+            function = tool_call.get("function") or {}
+            if function.get("name"):
+                entry["name"] = function["name"]
+            if function.get("arguments"):
+                entry["arguments"].append(function["arguments"])
+        if choice.get("finish_reason") or message.get("tool_calls"):
+            return self.flush()
+        return []
+
+    def flush(self):
+        commands = []
+        for index in sorted(self._calls):
+            entry = self._calls[index]
+            command = _tool_call_to_command(entry["name"], "".join(entry["arguments"]))
+            if command is not None:
+                commands.append(command)
+        self._calls = {}
+        return commands
 
 
 app = FastAPI(title="LLM + KLayout Logger")
-logger = AppLogger(LOG_PATH)
+_sidecar = _SidecarClient(SIDECAR_SOCKET) if SIDECAR_SOCKET else None
+# Only __main__ truncates the log, once, before any worker starts.
+logger = _sidecar or AppLogger(LOG_PATH, truncate=False)
+
+
+class _Upstream:
+    """One OpenAI-compatible endpoint of the pool."""
+
+    def __init__(self, url, weight=1.0, models=None, health_url=None):
+        self.url = url
+        self.weight = max(float(weight), 0.001)
+        self.models = dict(models or {})
+        self.health_url = health_url or url.rsplit("/chat/completions", 1)[0] + "/models"
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def model_for(self, model):
+        return self.models.get(model, model)
+
+
+class _UpstreamPool:
+    """Least-outstanding-requests routing (scaled by weight) with ejection.
+
+    An upstream that fails UPSTREAM_MAX_FAILURES times in a row, on requests
+    or on the periodic health check, is skipped for UPSTREAM_EJECT_SECONDS;
+    a passing health check lets it back in early.
+    """
+
+    def __init__(self, upstreams):
+        self.upstreams = upstreams
+        self._health_task = None
+
+    @classmethod
+    def from_config(cls, config):
+        if not config:
+            return cls([_Upstream(LLM_ENDPOINT)])
+        if not config.lstrip().startswith("["):
+            with open(config, "r", encoding="utf-8") as handle:
+                config = handle.read()
+        return cls([_Upstream(**entry) for entry in json.loads(config)])
+
+    def acquire(self, exclude=()):
+        """Pick the least loaded healthy upstream not in ``exclude``."""
+        now = time.monotonic()
+        candidates = [upstream for upstream in self.upstreams if upstream not in exclude]
+        healthy = [upstream for upstream in candidates if upstream.ejected_until <= now]
+        # With every upstream ejected, trying one still beats failing outright.
+        candidates = healthy or candidates
+        if not candidates:
+            return None
+        upstream = min(candidates, key=lambda item: (item.outstanding + 1) / item.weight)
+        upstream.outstanding += 1
+        return upstream
+
+    def release(self, upstream):
+        upstream.outstanding -= 1
+
+    def succeeded(self, upstream):
+        upstream.failures = 0
+        upstream.ejected_until = 0.0
+
+    def failed(self, upstream):
+        upstream.failures += 1
+        if upstream.failures >= UPSTREAM_MAX_FAILURES:
+            upstream.ejected_until = time.monotonic() + UPSTREAM_EJECT_SECONDS
+
+    def ensure_health_checks(self):
+        if len(self.upstreams) < 2 or UPSTREAM_HEALTH_INTERVAL <= 0:
+            return
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.get_running_loop().create_task(self._health_loop())
+
+    async def _health_loop(self):
+        async with httpx.AsyncClient(timeout=UPSTREAM_HEALTH_TIMEOUT) as client:
+            while True:
+                await asyncio.gather(
+                    *(self._check(client, upstream) for upstream in self.upstreams)
+                )
+                await asyncio.sleep(UPSTREAM_HEALTH_INTERVAL)
+
+    async def _check(self, client, upstream):
+        try:
+            response = await client.get(upstream.health_url)
+            healthy = response.status_code < 500
+        except httpx.HTTPError:
+            healthy = False
+        if healthy:
+            self.succeeded(upstream)
+        else:
+            self.failed(upstream)
+
+
+_upstreams = _UpstreamPool.from_config(LLM_UPSTREAMS)
+
+
+class _UpstreamUnavailable(Exception):
+    """The upstream failed before sending anything; another one may be tried."""
+
+
+async def _upstream_chunks(body, span):
+    """Raw upstream SSE bytes: from the LLM, or from the cassette when replaying."""
+    if isinstance(_cassette, CassettePlayer):
+        span.attributes["llm.replay"] = True
+        async for chunk in _cassette.stream():
+            yield chunk
+        return
+    tried = []
+    last_error = None
+    while True:
+        upstream = _upstreams.acquire(tried)
+        if upstream is None:
+            raise last_error or RuntimeError("No LLM upstream configured")
+        tried.append(upstream)
+        span.attributes["server.address"] = upstream.url
+        span.attributes["llm.attempts"] = len(tried)
+        payload = dict(body, model=upstream.model_for(body.get("model")))
+        started = time.monotonic()
+        sent = False
+        try:
+            async with httpx.AsyncClient(timeout=None) as client:
+                async with client.stream(
+                    "POST",
+                    upstream.url,
+                    json=payload,
+                    headers={
+                        "Content-Type": "application/json",
+                        "Accept": "text/event-stream",
+                    },
+                ) as response:
+                    span.attributes["http.status_code"] = response.status_code
+                    if response.status_code >= 500 and len(tried) < len(_upstreams.upstreams):
+                        raise _UpstreamUnavailable(
+                            "%s answered HTTP %d" % (upstream.url, response.status_code)
+                        )
+                    chunks = response.aiter_bytes()
+                    if _cassette is not None:
+                        chunks = _cassette.record_stream(chunks, started)
+                    try:
+                        async for chunk in chunks:
+                            sent = True
+                            yield chunk
+                    finally:
+                        await chunks.aclose()
+            # A 5xx passed through because no other upstream is left still
+            # counts against this one.
+            if response.status_code >= 500:
+                _upstreams.failed(upstream)
+            else:
+                _upstreams.succeeded(upstream)
+            return
+        except (httpx.TransportError, _UpstreamUnavailable) as exc:
+            _upstreams.failed(upstream)
+            if sent:
+                raise
+            # Nothing reached the client yet: retry on another upstream.
+            last_error = exc
+        finally:
+            _upstreams.release(upstream)
+
+
+async def _watch_disconnect(request, on_disconnect):
+    """Call ``on_disconnect`` as soon as the client goes away.
+
+    Streaming responses only notice a gone client when a write fails, which
+    may be long after the upstream and KLayout did the work for nothing.
+    """
+    while True:
+        message = await request.receive()
+        if message["type"] == "http.disconnect":
+            on_disconnect()
+            return
+
+
+@app.get("/stats")
+async def stats():
+    cancellations = dict(_CANCELLATIONS)
+    if _sidecar is not None:
+        try:
+            remote = await _sidecar.stats()
+        except (OSError, RuntimeError):
+            remote = {}
+        for key, value in remote.items():
+            cancellations[key] = cancellations.get(key, 0) + value
+    return {"pid": os.getpid(), "cancellations": cancellations}
 
 
 @app.post("/chat/completions")
 async def proxy_request(request: Request):
     body_bytes = await request.body()
     body_str = body_bytes.decode("utf-8")
+    _upstreams.ensure_health_checks()
+    if _sidecar is not None:
+        try:
+            await _sidecar.connect()
+        except OSError as exc:
+            print("[SIDECAR] connect error: %s" % exc, file=sys.stderr)
     logger.log(f"模型请求：{body_str}")
     body = await request.json()
     body["model"] = LLM_MODEL
 
     logger.log("模型返回：\n")
+    root_span = _Span(
+        "chat.completions", kind="SERVER",
+        **{"http.route": "/chat/completions", "llm.model": LLM_MODEL},
+    )
 
-    async def event_stream():
+    async def pump(out):
+        """Read the upstream into ``out`` and dispatch tool calls as they complete."""
         buffer_text = ""
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream(
-                "POST",
-                LLM_ENDPOINT,
-                json=body,
-                headers={
-                    "Content-Type": "application/json",
-                    "Accept": "text/event-stream",
-                },
-            ) as response:
-                async for line in response.aiter_lines():
-                    logger.log(line)
-                    content = _extract_content_from_event(line)
+        pending = bytearray()
+        tool_calls = _ToolCallAssembler()
+        llm_span = root_span.child("llm.stream", "CLIENT")
+        received = 0
+        finished = False
+        cancelled = False
+        error = None
+        chunks = _upstream_chunks(body, llm_span)
+        try:
+            async for chunk in chunks:
+                if not received:
+                    llm_span.attributes["llm.first_byte_ms"] = round(
+                        (time.time_ns() - llm_span.start_ns) / 1e6, 3
+                    )
+                received += len(chunk)
+                # Forward upstream bytes untouched; parse on the side. Blocks
+                # while the client is behind, which throttles the upstream.
+                await out.put(chunk)
+                pending += chunk
+                end = pending.rfind(b"\n") + 1
+                if not end:
+                    continue
+                complete = bytes(pending[:end])
+                del pending[:end]
+                logger.log_bytes(complete)
+                for line in complete.split(b"\n"):
+                    data = _decode_sse_data(line)
+                    if data is None:
+                        continue
+                    commands = tool_calls.feed(data)
+                    content = _content_from_event_data(data)
                     if content:
                         buffer_text += content
-                        commands, buffer_text = _extract_klayout_commands(buffer_text)
-                        for command in commands:
-                            _send_klayout_command(command, logger)
+                        found, buffer_text = _extract_klayout_commands(buffer_text)
+                        commands.extend(found)
                         if len(buffer_text) > 8192:
                             buffer_text = buffer_text[-4096:]
-                    yield f"{line}\n"
+                    if commands:
+                        await _dispatch(commands, root_span)
+            finished = True
+            llm_span.attributes["llm.response_bytes"] = received
+            llm_span.end()
+            if pending:
+                logger.log_bytes(bytes(pending) + b"\n")
+            commands = tool_calls.flush()
+            if commands:
+                await _dispatch(commands, root_span)
+        except asyncio.CancelledError:
+            if not _task_cancelled():
+                # Not a disconnect: end the stream with an error instead of
+                # leaving the client waiting for a marker that never comes.
+                error = RuntimeError("a tool call was cancelled")
+            else:
+                cancelled = True
+                error = "client disconnected"
+                if not finished:
+                    _CANCELLATIONS["upstream_aborts"] += 1
+                raise
+        except Exception as exc:
+            error = exc
+        finally:
+            await chunks.aclose()
+            llm_span.attributes["llm.response_bytes"] = received
+            llm_span.end(error)
+            root_span.end(error)
+            if not cancelled:
+                await out.put(error)
+
+    async def event_stream():
+        out = asyncio.Queue(STREAM_QUEUE_CHUNKS)
+        producer = asyncio.ensure_future(pump(out))
+        aborted = []
+
+        def abort():
+            if not producer.done() and not aborted:
+                aborted.append(True)
+                _CANCELLATIONS["client_disconnects"] += 1
+                logger.log("[CANCEL] client disconnected; aborting upstream and tool calls")
+                producer.cancel()
+
+        watcher = asyncio.ensure_future(_watch_disconnect(request, abort))
+        try:
+            while True:
+                item = await out.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            watcher.cancel()
+            abort()
 
-    return StreamingResponse(event_stream(), media_type="text/event-stream")
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"X-Trace-Id": root_span.trace_id},
+    )
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=PROXY_PORT)
+    logger.truncate()
+    if PROXY_WORKERS > 1:
+        _start_sidecar(SIDECAR_PATH)
+        os.environ["LLM_SIDECAR_SOCKET"] = SIDECAR_PATH
+        uvicorn.run(
+            "llm_klayout_logger:app", host="0.0.0.0", port=PROXY_PORT, workers=PROXY_WORKERS
+        )
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=PROXY_PORT)
@@ -11,8 +11,19 @@
 # - Assumes OpenAI-compatible /v1/chat/completions:
 #   response: {"choices":[{"message":{"content":"..."}}]}
 # - If your server returns different JSON, adapt _parse_llm_response().
-
+#
+# Tools:
+# - Replies containing .clinerules-style tool blocks
+#   {"tool":"klayout","method":"<method>","params":{...}}
+#   are executed in-process through macro_klayout_tcp_server.call_tool(),
+#   and the results are fed back to the model (no TCP / proxy hop).
+
+import collections
+import html
+import importlib.util
 import json
+import os
+import sys
 import traceback
 import urllib.request
 import urllib.error
@@ -22,6 +33,34 @@ import pya
 
 DOCK_OBJECT_NAME = "KLAYOUT_AI_CHAT_DOCK_V1"
 
+# 對話脈絡的 token 預算（含 system prompt 與摘要），超過時最舊的回合會被摺入摘要
+CONTEXT_TOKEN_BUDGET = 6000
+# 滾動摘要最多佔用的 token 數
+SUMMARY_TOKEN_BUDGET = 800
+# 每則被摺入摘要的訊息最多保留的字元數
+SUMMARY_SNIPPET_CHARS = 160
+
+TOOL_NAME = "klayout"
+TOOL_MODULE_NAME = "macro_klayout_tcp_server"
+_HERE = os.path.dirname(os.path.abspath(__file__)) if "__file__" in globals() else os.getcwd()
+TOOL_MODULE_PATH = os.path.join(_HERE, TOOL_MODULE_NAME + ".py")
+# 單次送出最多連續執行幾輪工具呼叫
+MAX_TOOL_ROUNDS = 4
+# 回傳給模型的單一工具結果最多字元數
+TOOL_RESULT_MAX_CHARS = 8000
+# snapshot 工具回傳的圖片以 image_url 附給視覺模型時，每張估計的 token 數
+IMAGE_TOKEN_ESTIMATE = 800
+
+# transcript 最多保留的文字區塊數（QTextDocument block），超過時自動丟棄最舊的
+TRANSCRIPT_MAX_BLOCKS = 2000
+# 超過此字元數的訊息只顯示開頭，完整內容點擊後才展開
+FOLD_THRESHOLD_CHARS = 1500
+FOLD_PREVIEW_CHARS = 400
+# 保留可展開完整內容的訊息則數
+FOLD_CACHE_SIZE = 64
+# 設定路徑後，transcript 會同步寫入此檔，被丟棄的舊紀錄仍可從檔案查閱
+TRANSCRIPT_SPILL_PATH = None
+
 
 # ---------- Qt compatibility helpers ----------
 def _qt_value(x):
@@ -80,6 +119,168 @@ def _parse_llm_response(raw_json_text):
         raise RuntimeError("無法解析回覆格式，原始回覆如下：\n" + raw_json_text[:2000])
 
 
+# ---------- In-process tools ----------
+def _load_tool_module():
+    """
+    載入 TCP server macro 的 handler（同一個 KLayout process 內），
+    以 sys.modules 快取；模組只在 __main__ 時才會啟動 TCP server。
+    server macro 已在執行時沿用它那一份（登記在 sys.modules 或就是 __main__），
+    避免第二份模組各自持有 generation、快取與 shared buffer。
+    """
+    module = sys.modules.get(TOOL_MODULE_NAME)
+    if module is not None:
+        return module
+    main = sys.modules.get("__main__")
+    if main is not None and hasattr(main, "_TOOL_HANDLERS") and hasattr(main, "call_tool"):
+        return main
+    spec = importlib.util.spec_from_file_location(TOOL_MODULE_NAME, TOOL_MODULE_PATH)
+    if spec is None:
+        raise RuntimeError("找不到工具模組：" + TOOL_MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[TOOL_MODULE_NAME] = module
+    return module
+
+
+def _tool_methods():
+    try:
+        return sorted(_load_tool_module()._TOOL_HANDLERS)
+    except Exception:
+        return []
+
+
+def _extract_tool_blocks(text):
+    """
+    Find {"tool":"klayout","method":...} objects in an assistant reply.
+    """
+    decoder = json.JSONDecoder()
+    blocks = []
+    idx = text.find("{")
+    while idx >= 0:
+        try:
+            obj, end = decoder.raw_decode(text, idx)
+        except ValueError:
+            idx = text.find("{", idx + 1)
+            continue
+        if isinstance(obj, dict) and obj.get("tool") == TOOL_NAME and obj.get("method"):
+            blocks.append(obj)
+        idx = text.find("{", end)
+    return blocks
+
+
+def _run_tool_block(block):
+    """
+    執行一個工具區塊，回傳 (結果文字, 圖片 data URL 清單)。
+    snapshot 的圖片不放進文字，改以 image_url 附給視覺模型。
+    """
+    method = block.get("method")
+    params = block.get("params") or {}
+    if isinstance(params, dict) and "shm" in params:
+        # shared memory handle 對模型沒有用，也不會有人釋放
+        params = dict(params)
+        params.pop("shm")
+    images = []
+    try:
+        result = _load_tool_module().call_tool(method, params)
+        if method == "snapshot" and isinstance(result, dict) and result.get("data"):
+            result = dict(result)
+            images.append("data:image/%s;base64,%s" % (result.get("format", "png"), result.pop("data")))
+            result["data"] = "(image attached)"
+        reply = {"method": method, "ok": True, "result": result}
+    except Exception as e:
+        reply = {"method": method, "ok": False, "error": str(e)}
+    text = json.dumps(reply, ensure_ascii=False, default=str)
+    if len(text) > TOOL_RESULT_MAX_CHARS:
+        text = text[:TOOL_RESULT_MAX_CHARS] + "…(truncated)"
+    return text, images
+
+
+def _content_text(content):
+    # content 可能是字串，或 OpenAI 多模態 parts 清單
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+    return str(content or "")
+
+
+# ---------- Conversation context ----------
+def _estimate_tokens(text):
+    """
+    粗估 token 數：CJK 字元約 1 token，其餘約 4 字元 1 token，
+    再加上每則訊息固定的角色/格式開銷。
+    """
+    text = text or ""
+    wide = 0
+    for ch in text:
+        if ord(ch) >= 0x2E80:
+            wide += 1
+    return wide + (len(text) - wide + 3) // 4 + 4
+
+
+class _ContextWindow(object):
+    """
+    Keep the conversation sent to the LLM within a token budget.
+
+    Recent turns are kept verbatim; when the budget is exceeded the oldest
+    turns are evicted and folded into a rolling summary. Token estimates and
+    the summary are cached, so each turn only pays for what changed.
+    """
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, summary_budget=SUMMARY_TOKEN_BUDGET):
+        self.token_budget = int(token_budget)
+        self.summary_budget = int(summary_budget)
+        self.clear()
+
+    def clear(self):
+        self._turns = []  # [(message, tokens)]
+        self._turn_tokens = 0
+        self._summary_lines = []  # [(line, tokens)]
+        self._summary_tokens = 0
+
+    def append(self, role, content):
+        message = {"role": role, "content": content}
+        tokens = _estimate_tokens(_content_text(content))
+        if isinstance(content, list):
+            tokens += IMAGE_TOKEN_ESTIMATE * sum(1 for part in content if part.get("type") == "image_url")
+        self._turns.append((message, tokens))
+        self._turn_tokens += tokens
+
+    def set_budget(self, token_budget):
+        self.token_budget = max(int(token_budget), 1)
+
+    def build(self, system_prompt):
+        """
+        Return the message list for the next request:
+        system prompt, rolling summary (if any), then the most recent turns.
+        """
+        system_tokens = _estimate_tokens(system_prompt)
+        # 最新一則訊息一定保留，即使它本身已超過預算
+        while len(self._turns) > 1 and (
+            system_tokens + self._summary_tokens + self._turn_tokens > self.token_budget
+        ):
+            message, tokens = self._turns.pop(0)
+            self._turn_tokens -= tokens
+            self._fold_into_summary(message)
+
+        messages = [{"role": "system", "content": system_prompt}]
+        if self._summary_lines:
+            summary = "\n".join(line for line, _ in self._summary_lines)
+            messages.append({"role": "system", "content": "先前對話摘要：\n" + summary})
+        messages.extend(message for message, _ in self._turns)
+        return messages
+
+    def _fold_into_summary(self, message):
+        text = " ".join(_content_text(message.get("content")).split())
+        if len(text) > SUMMARY_SNIPPET_CHARS:
+            text = text[:SUMMARY_SNIPPET_CHARS] + "…"
+        line = "- %s: %s" % (message.get("role"), text)
+        tokens = _estimate_tokens(line)
+        self._summary_lines.append((line, tokens))
+        self._summary_tokens += tokens
+        while len(self._summary_lines) > 1 and self._summary_tokens > self.summary_budget:
+            _, dropped = self._summary_lines.pop(0)
+            self._summary_tokens -= dropped
+
+
 # ---------- Input box (Enter send / Shift+Enter newline) ----------
 class _InputBox(pya.QPlainTextEdit):
     def __init__(self, parent=None, on_send=None):
@@ -111,16 +312,106 @@ class _InputBox(pya.QPlainTextEdit):
         return super(_InputBox, self).keyPressEvent(event)
 
 
+# ---------- Transcript ----------
+class _TranscriptView(pya.QTextBrowser):
+    """
+    Read-only transcript with a bounded document.
+
+    - At most max_blocks text blocks are kept; Qt drops the oldest ones.
+    - Messages longer than FOLD_THRESHOLD_CHARS are shown as a short preview
+      with a link; the full text is only rendered when the link is clicked.
+    - With spill_path set, every message is also appended to that file.
+    """
+
+    def __init__(self, parent=None, max_blocks=TRANSCRIPT_MAX_BLOCKS, spill_path=TRANSCRIPT_SPILL_PATH):
+        super(_TranscriptView, self).__init__(parent)
+        self.setReadOnly(True)
+        self.setOpenLinks(False)
+        self.setUndoRedoEnabled(False)
+        self.document().setMaximumBlockCount(int(max_blocks))
+        self._spill_path = spill_path
+        self._folded = collections.OrderedDict()  # fold id -> (prefix, text)
+        self._next_fold_id = 0
+        self.anchorClicked.connect(self._on_anchor_clicked)
+
+    def add_message(self, prefix, text):
+        self._spill(prefix, text)
+        if len(text) <= FOLD_THRESHOLD_CHARS:
+            self.append(f"{prefix}\n{text}\n")
+            return
+
+        fold_id = self._next_fold_id
+        self._next_fold_id += 1
+        self._folded[fold_id] = (prefix, text)
+        while len(self._folded) > FOLD_CACHE_SIZE:
+            self._folded.popitem(last=False)
+
+        preview = html.escape(text[:FOLD_PREVIEW_CHARS]).replace("\n", "<br>")
+        self.append(
+            f"{html.escape(prefix)}<br>{preview}… "
+            f'<a href="fold:{fold_id}">[展開全部 {len(text)} 字元]</a><br>'
+        )
+
+    def clear_transcript(self):
+        self.clear()
+        self._folded.clear()
+
+    def _spill(self, prefix, text):
+        if not self._spill_path:
+            return
+        try:
+            with open(self._spill_path, "a", encoding="utf-8") as handle:
+                handle.write(f"{prefix}\n{text}\n\n")
+        except OSError:
+            pass
+
+    def _on_anchor_clicked(self, url):
+        target = str(_qt_value(getattr(url, "toString")))
+        if not target.startswith("fold:"):
+            return
+        try:
+            entry = self._folded.get(int(target[5:]))
+        except ValueError:
+            entry = None
+        if entry is None:
+            note = "此內容已超出保留範圍。"
+            if self._spill_path:
+                note += "\n完整紀錄請見：" + self._spill_path
+            pya.MessageBox.info("AI Chat", note, pya.MessageBox.Ok)
+            return
+        prefix, text = entry
+        self._show_payload(prefix, text)
+
+    def _show_payload(self, title, text):
+        dlg = pya.QDialog(self)
+        dlg.setWindowTitle(title)
+        layout = pya.QVBoxLayout(dlg)
+        view = pya.QPlainTextEdit(dlg)
+        view.setReadOnly(True)
+        view.setPlainText(text)
+        layout.addWidget(view)
+        dlg.resize(720, 480)
+        dlg.exec_()
+
+
 class _ChatPanel(pya.QWidget):
     def __init__(self, parent=None):
         super(_ChatPanel, self).__init__(parent)
 
-        self._messages = []  # [{"role": "user"/"assistant", "content": "..."}]
+        self._context = _ContextWindow()
         self._system_prompt = (
             "你是在 KLayout 內的助理。"
             "回答請以繁體中文、精簡且可執行為主。"
             "若不確定，請先說不確定並提出需要的資訊。"
         )
+        methods = _tool_methods()
+        if methods:
+            self._system_prompt += (
+                "需要操作 layout 時，請在單獨一行輸出 JSON 工具區塊（不要加 markdown 圍欄）："
+                '{"tool":"klayout","method":"<method>","params":{...}}。'
+                "可用 method：" + ", ".join(methods) + "。"
+                "路徑參數請用 path。工具結果會自動回傳給你。"
+            )
 
         root = pya.QVBoxLayout(self)
 
@@ -129,6 +420,8 @@ class _ChatPanel(pya.QWidget):
         self.ed_base_url = pya.QLineEdit("http://127.0.0.1:1234", self)
         self.ed_endpoint = pya.QLineEdit("/v1/chat/completions", self)
         self.ed_model = pya.QLineEdit("qwen3-vl-8b-instruct-mlx", self)
+        self.ed_budget = pya.QLineEdit(str(CONTEXT_TOKEN_BUDGET), self)
+        self.ed_budget.setToolTip("對話脈絡 token 預算")
 
         self.btn_clear = pya.QPushButton("Clear", self)
         self.btn_clear.clicked.connect(self._on_clear)
@@ -139,13 +432,14 @@ class _ChatPanel(pya.QWidget):
         settings.addWidget(self.ed_endpoint, 2)
         settings.addWidget(pya.QLabel("Model", self))
         settings.addWidget(self.ed_model, 2)
+        settings.addWidget(pya.QLabel("Ctx", self))
+        settings.addWidget(self.ed_budget, 1)
         settings.addWidget(self.btn_clear, 0)
 
         root.addLayout(settings)
 
         # --- transcript ---
-        self.txt_log = pya.QTextEdit(self)
-        self.txt_log.setReadOnly(True)
+        self.txt_log = _TranscriptView(self)
         root.addWidget(self.txt_log, 1)
 
         # --- input row ---
@@ -170,13 +464,15 @@ class _ChatPanel(pya.QWidget):
             prefix = "AI："
         elif role == "system":
             prefix = "[系統]"
+        elif role == "tool":
+            prefix = "[工具]"
         else:
             prefix = "[錯誤]"
-        self.txt_log.append(f"{prefix}\n{text}\n")
+        self.txt_log.add_message(prefix, text)
 
     def _on_clear(self):
-        self._messages = []
-        self.txt_log.clear()
+        self._context.clear()
+        self.txt_log.clear_transcript()
         self._append("system", "已清空對話。")
 
     def _on_send(self):
@@ -186,18 +482,50 @@ class _ChatPanel(pya.QWidget):
         self.ed_input.setPlainText("")
 
         self._append("user", user_text)
-        self._messages.append({"role": "user", "content": user_text})
+        self._context.append("user", user_text)
 
         try:
-            assistant_text = self._call_llm(self._system_prompt, self._messages)
-            if not assistant_text:
-                assistant_text = "(空回覆)"
-            self._append("assistant", assistant_text)
-            self._messages.append({"role": "assistant", "content": assistant_text})
+            self._apply_budget()
+            rounds = 0
+            while True:
+                assistant_text = self._call_llm(self._context.build(self._system_prompt))
+                if not assistant_text:
+                    assistant_text = "(空回覆)"
+                self._append("assistant", assistant_text)
+                self._context.append("assistant", assistant_text)
+                blocks = _extract_tool_blocks(assistant_text)
+                if not blocks:
+                    break
+                if rounds >= MAX_TOOL_ROUNDS:
+                    self._append("system", "已達工具呼叫上限（%d 輪），停止執行。" % MAX_TOOL_ROUNDS)
+                    break
+                rounds += 1
+                self._context.append("user", self._run_tools(blocks))
         except Exception as e:
             self._append("error", f"呼叫失敗：{e}\n\n{traceback.format_exc()}")
 
-    def _call_llm(self, system_prompt, messages):
+    def _run_tools(self, blocks):
+        results = []
+        images = []
+        for block in blocks:
+            text, block_images = _run_tool_block(block)
+            self._append("tool", text)
+            results.append(text)
+            images.extend(block_images)
+        text = "工具結果：\n" + "\n".join(results)
+        if not images:
+            return text
+        return [{"type": "text", "text": text}] + [
+            {"type": "image_url", "image_url": {"url": url}} for url in images
+        ]
+
+    def _apply_budget(self):
+        try:
+            self._context.set_budget(int(_qline_text(self.ed_budget).strip()))
+        except ValueError:
+            pass
+
+    def _call_llm(self, messages):
         base_url = _qline_text(self.ed_base_url).strip().rstrip("/")
         endpoint = _qline_text(self.ed_endpoint).strip()
         if not endpoint.startswith("/"):
@@ -208,7 +536,7 @@ class _ChatPanel(pya.QWidget):
 
         payload = {
             "model": model,
-            "messages": [{"role": "system", "content": system_prompt}] + messages,
+            "messages": messages,
             "temperature": 0.2,
             "stream": False
         }
@@ -1,7 +1,25 @@
+import json
 import os
+import sys
+from array import array
+
 import pya
 
 
+# Bulk export: set BULK_EXPORT = True to dump whole layers instead of the selection.
+# Each layer is written as <cell>_<layer>_<datatype>.coords.i32 (x, y pairs) and
+# .offsets.i64 (point offset of each polygon, n + 1 entries), plus a JSON manifest.
+# Values are in native byte order, recorded in the manifest as coords_dtype and
+# offsets_dtype ("<i4"/"<i8" on little-endian machines). NumPy:
+#   np.memmap(coords, dtype=manifest["coords_dtype"]).reshape(-1, 2)
+#   np.memmap(offsets, dtype=manifest["offsets_dtype"])
+BULK_EXPORT = False
+BULK_LAYERS = []  # e.g. ["1/0", "2/0"]; empty means all layers
+BULK_FLATTEN = True  # include shapes of child cells
+BULK_WINDOW = None  # (x1, y1, x2, y2) in microns; shapes are clipped to it
+BULK_CHUNK = 1 << 16  # values buffered per column before writing to disk
+
+
 def export_selected_polygon():
     app = pya.Application.instance()
     mw = app.main_window()
@@ -77,4 +95,151 @@ def export_selected_polygon():
     pya.MessageBox.info("Export", f"Saved to:\n{out_path}", pya.MessageBox.Ok)
 
 
-export_selected_polygon()
+class _ColumnarLayerWriter(object):
+    def __init__(self, base_path):
+        self.coords_path = base_path + ".coords.i32"
+        self.offsets_path = base_path + ".offsets.i64"
+        self._coords = open(self.coords_path, "wb")
+        self._offsets = open(self.offsets_path, "wb")
+        self._coord_buf = array("i")
+        self._offset_buf = array("q", [0])
+        self.polygons = 0
+        self.points = 0
+
+    def add(self, poly):
+        buf = self._coord_buf
+        for pt in poly.each_point_hull():
+            buf.append(pt.x)
+            buf.append(pt.y)
+            self.points += 1
+        self.polygons += 1
+        self._offset_buf.append(self.points)
+        if len(buf) >= BULK_CHUNK or len(self._offset_buf) >= BULK_CHUNK:
+            self._flush()
+
+    def _flush(self):
+        self._coord_buf.tofile(self._coords)
+        self._offset_buf.tofile(self._offsets)
+        del self._coord_buf[:]
+        del self._offset_buf[:]
+
+    def close(self):
+        self._flush()
+        self._coords.close()
+        self._offsets.close()
+
+
+def _resolve_layers(layout, specs):
+    if not specs:
+        return list(layout.layer_indexes())
+    indexes = []
+    for spec in specs:
+        layer, datatype = (int(v) for v in spec.split("/"))
+        index = layout.find_layer(pya.LayerInfo(layer, datatype))
+        if index is None:
+            raise RuntimeError(f"Layer not found: {spec}")
+        indexes.append(index)
+    return indexes
+
+
+def _iter_layer_polygons(cell, layer_index, flatten, window):
+    if window is None:
+        it = cell.begin_shapes_rec(layer_index)
+        clip = None
+    else:
+        it = cell.begin_shapes_rec_touching(layer_index, window)
+        clip = pya.Region(window)
+    if not flatten:
+        it.max_depth = 0
+    while not it.at_end():
+        shape = it.shape()
+        if shape.is_polygon() or shape.is_box() or shape.is_path():
+            poly = shape.polygon.transformed(it.trans())
+            if clip is None or poly.bbox().inside(window):
+                yield poly
+            else:
+                for part in (pya.Region(poly) & clip).each():
+                    yield part
+        it.next()
+
+
+def export_layers_bulk():
+    app = pya.Application.instance()
+    mw = app.main_window()
+    view = mw.current_view() if mw else None
+    if view is None:
+        pya.MessageBox.warning("Export", "No active view.", pya.MessageBox.Ok)
+        return
+
+    cv = view.active_cellview()
+    if cv is None or not cv.is_valid():
+        pya.MessageBox.warning("Export", "No active cellview.", pya.MessageBox.Ok)
+        return
+
+    layout = cv.layout()
+    gds_path = cv.filename()
+    if not gds_path:
+        pya.MessageBox.warning(
+            "Export", "Please save the GDS first.", pya.MessageBox.Ok
+        )
+        return
+
+    try:
+        layer_indexes = _resolve_layers(layout, BULK_LAYERS)
+    except (RuntimeError, ValueError) as exc:
+        pya.MessageBox.warning("Export", str(exc), pya.MessageBox.Ok)
+        return
+
+    window = None
+    if BULK_WINDOW is not None:
+        window = pya.DBox(*BULK_WINDOW).to_itype(layout.dbu)
+
+    cell = cv.cell
+    out_dir = os.path.dirname(gds_path)
+    endian = "<" if sys.byteorder == "little" else ">"
+    manifest = {
+        "cell": cell.name,
+        "dbu": layout.dbu,
+        "flatten": BULK_FLATTEN,
+        "window": list(BULK_WINDOW) if BULK_WINDOW is not None else None,
+        "coords_dtype": endian + "i4",
+        "offsets_dtype": endian + "i8",
+        "layers": [],
+    }
+    for layer_index in layer_indexes:
+        info = layout.get_info(layer_index)
+        base = os.path.join(out_dir, f"{cell.name}_{info.layer}_{info.datatype}")
+        writer = _ColumnarLayerWriter(base)
+        try:
+            for poly in _iter_layer_polygons(cell, layer_index, BULK_FLATTEN, window):
+                if poly.holes():
+                    poly = poly.resolved_holes()
+                writer.add(poly)
+        finally:
+            writer.close()
+        manifest["layers"].append(
+            {
+                "layer": f"{info.layer}/{info.datatype}",
+                "polygons": writer.polygons,
+                "points": writer.points,
+                "coords": os.path.basename(writer.coords_path),
+                "offsets": os.path.basename(writer.offsets_path),
+            }
+        )
+
+    manifest_path = os.path.join(out_dir, f"{cell.name}_bulk_export.json")
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+
+    total = sum(entry["polygons"] for entry in manifest["layers"])
+    pya.MessageBox.info(
+        "Export",
+        f"Exported {total} polygons on {len(layer_indexes)} layers.\nManifest:\n{manifest_path}",
+        pya.MessageBox.Ok,
+    )
+
+
+if BULK_EXPORT:
+    export_layers_bulk()
+else:
+    export_selected_polygon()
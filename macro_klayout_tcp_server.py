@@ -1,57 +1,288 @@
+import array
+import base64
+import collections
+import hashlib
 import json
+import math
 import os
+import sys
+import tempfile
+import time
 import traceback
 
 import pya
 
 
 HOST = "127.0.0.1"
-PORT = 9009
+# KLAYOUT_TCP_PORT=0 turns the TCP listener off (local socket only).
+PORT = int(os.environ.get("KLAYOUT_TCP_PORT") or 9009)
+# Path of an extra local-socket listener (Unix domain socket, or named pipe
+# on Windows), accessible to the current user only; unset disables it.
+LOCAL_SOCKET_PATH = os.environ.get("KLAYOUT_LOCAL_SOCKET") or None
+# Bytes Qt may hold for a socket before further writes are queued in Python.
+OUTBOUND_SOFT_LIMIT = 1 << 20
+# Queued bytes per connection beyond which the client is disconnected.
+OUTBOUND_HARD_LIMIT = 8 << 20
+# Seconds a client may stay over the soft limit before it is disconnected.
+OUTBOUND_STALL_SECONDS = 10.0
+# Longest time spent handling requests before yielding to the Qt event loop.
+REQUEST_SLICE_SECONDS = 0.02
+# Parsed requests queued per connection; further input stays in the socket.
+MAX_PENDING_REQUESTS = 64
+# Sustained requests per second per connection (token bucket); 0 disables.
+MAX_REQUESTS_PER_SECOND = 200
+# Bytes Qt reads ahead per socket; beyond that TCP flow control applies.
+READ_BUFFER_LIMIT = 1 << 20
+# Tile edge (microns) for tiled geometry operations.
+TILE_MICRONS = 200.0
+# Default tile edge (microns) of density maps, upper bound of values in one
+# map, and maps kept for the current layout generation.
+DENSITY_TILE_MICRONS = 50.0
+DENSITY_MAX_TILES = 4000000
+DENSITY_CACHE_SIZE = 16
+# Items per page for paged results (diff polygons, tile summaries, ...).
+RESULT_PAGE_SIZE = 1000
+# Upper bound of items kept for one paged result.
+MAX_RESULT_ITEMS = 200000
+# Paged results kept server-side (oldest are dropped first).
+MAX_STORED_RESULTS = 16
+# Largest snapshot edge in pixels and default thumbnail edge.
+SNAPSHOT_MAX_PIXELS = 4096
+SNAPSHOT_THUMBNAIL = 256
+# Encoded snapshots kept in memory (rendered images: a quarter of that).
+SNAPSHOT_CACHE_SIZE = 32
+# Upper bound of pixel data held by cached renders (4 bytes per pixel).
+SNAPSHOT_IMAGE_CACHE_BYTES = 128 << 20
+# Upper bound of nodes returned by one cell_tree call.
+MAX_TREE_NODES = 5000
+# Spatial indexes (one per cell/layer) kept for pick queries.
+SPATIAL_INDEX_CACHE_SIZE = 16
+# Shapes covering more grid cells than this are checked on every query.
+SPATIAL_MAX_CELLS_PER_SHAPE = 64
+# Directory for OASIS copies of parsed input files; unset disables the cache.
+LAYOUT_CACHE_DIR = os.environ.get("KLAYOUT_LAYOUT_CACHE_DIR") or None
+LAYOUT_CACHE_MAX_BYTES = 4 << 30
+# Layouts read from paths (diff_layouts, check_rules) kept in memory.
+FILE_LAYOUT_CACHE_SIZE = 4
+# Directory for result arrays handed to local clients as mapped files ("shm"
+# param); /dev/shm keeps them in memory where it exists.
+SHARED_BUFFER_DIR = os.environ.get("KLAYOUT_SHARED_DIR") or (
+    "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+)
+# Seconds a shared result survives without release_buffer, and the total
+# size kept before the oldest ones are dropped.
+SHARED_BUFFER_TTL = 120.0
+SHARED_BUFFER_MAX_BYTES = 2 << 30
+# Poll interval of layout change subscriptions (edits raise no view signal),
+# and the largest cells x layers table compared on each poll.
+LAYOUT_WATCH_POLL_MS = 1000
+LAYOUT_WATCH_MAX_ENTRIES = 20000
+# Names listed per category in one layout_changed event.
+LAYOUT_EVENT_MAX_NAMES = 200
+# JSONL file for spans of traced requests; unset only echoes timings to the caller.
+TRACE_PATH = os.environ.get("KLAYOUT_TRACE_PATH") or None
+
+
+class _Inbound(object):
+    """Per-connection request queue with a token-bucket rate limit."""
+
+    def __init__(self, rate):
+        self.requests = collections.deque()
+        self.rate = rate
+        self.tokens = float(rate)
+        self.refilled_at = time.monotonic()
+
+    def take(self, now):
+        if not self.rate:
+            return True
+        self.tokens = min(float(self.rate), self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+    def wait_seconds(self):
+        return max(1.0 - self.tokens, 0.0) / self.rate
+
+
+class _Outbound(object):
+    """Per-connection write queue; coalesced events keep only the latest payload per key."""
+
+    def __init__(self):
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        self.latest = collections.OrderedDict()
+        self.over_since = None
+
+    def pending_bytes(self):
+        return self.queued_bytes + sum(len(p) for p in self.latest.values())
+
+
+class _LruCache(object):
+    """LRU map bounded by entry count and, with sizeof, by total size.
+
+    The newest entry is always kept, even when it alone exceeds max_bytes.
+    """
+
+    def __init__(self, max_entries, max_bytes=None, sizeof=None):
+        self._entries = collections.OrderedDict()
+        self._max_entries = max(int(max_entries), 1)
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._sizes = {}
+        self.bytes = 0
+
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._forget(key)
+        self._entries[key] = value
+        if self._sizeof is not None:
+            size = self._sizeof(value)
+            self._sizes[key] = size
+            self.bytes += size
+        while len(self._entries) > self._max_entries or (
+            self._max_bytes is not None
+            and self.bytes > self._max_bytes
+            and len(self._entries) > 1
+        ):
+            self._forget(next(iter(self._entries)))
+
+    def _forget(self, key):
+        self.bytes -= self._sizes.pop(key, 0)
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self.bytes = 0
 
 
 class _JsonTcpServer(object):
-    def __init__(self, host=HOST, port=PORT):
+    def __init__(
+        self,
+        host=HOST,
+        port=PORT,
+        slice_seconds=REQUEST_SLICE_SECONDS,
+        max_pending=MAX_PENDING_REQUESTS,
+        rate_limit=MAX_REQUESTS_PER_SECOND,
+        local_path=LOCAL_SOCKET_PATH,
+    ):
         self._host = host
         self._port = port
+        self._local_path = local_path
+        self._local_server = None
+        self._slice_seconds = slice_seconds
+        self._max_pending = max(int(max_pending), 1)
+        self._rate_limit = rate_limit
         self._server = pya.QTcpServer()
         self._buffers = {}
+        self._inbound = {}
+        self._outbound = {}
+        # Connections with queued requests, served round-robin.
+        self._ready = collections.deque()
+        self._work_timer = pya.QTimer(self._server)
+        self._work_timer.setSingleShot(True)
+        self._work_timer.timeout.connect(self._process_slice)
         self._selection_subscribers = set()
         self._selection_timer = pya.QTimer(self._server)
         self._selection_timer.setInterval(200)
         self._selection_timer.timeout.connect(self._on_selection_tick)
         self._selection_view = None
         self._last_selection = object()
-        self._server.newConnection.connect(self._on_new_connection)
+        self._layout_subscribers = set()
+        self._layout_watcher = _LayoutWatcher(self._server, self._notify_layout_change)
+        self._server.newConnection.connect(lambda: self._on_new_connection(self._server))
+        self._expire_timer = pya.QTimer(self._server)
+        self._expire_timer.setInterval(int(SHARED_BUFFER_TTL * 1000 / 4))
+        self._expire_timer.timeout.connect(_SHARED_BUFFERS.expire)
 
     def start(self):
+        if not self._port and not self._local_path:
+            raise RuntimeError("TCP is disabled and KLAYOUT_LOCAL_SOCKET is not set")
+        if self._local_path:
+            self._start_local()
+        if self._port:
+            self._start_tcp()
+        self._expire_timer.start()
+
+    def _start_tcp(self):
         host_addr = pya.QHostAddress(self._host)
-        if not self._server.listen(host_addr, int(self._port)):
-            raise RuntimeError("Failed to listen on %s:%s" % (self._host, self._port))
-        print("KLayout JSON TCP server listening on %s:%s" % (self._host, self._port))
+        if self._server.listen(host_addr, int(self._port)):
+            print("KLayout JSON TCP server listening on %s:%s" % (self._host, self._port))
+            return
+        error = self._server.errorString()
+        if not self._local_path:
+            raise RuntimeError("Failed to listen on %s:%s: %s" % (self._host, self._port, error))
+        # A port clash need not take the server down when the local socket is up.
+        print(
+            "KLayout JSON TCP server: could not listen on %s:%s (%s); serving %s only"
+            % (self._host, self._port, error, self._local_path)
+        )
+
+    def _start_local(self):
+        server = pya.QLocalServer()
+        # Drop a socket file left behind by a crashed session.
+        pya.QLocalServer.removeServer(self._local_path)
+        server.setSocketOptions(pya.QLocalServer.UserAccessOption)
+        if not server.listen(self._local_path):
+            raise RuntimeError(
+                "Failed to listen on %s: %s" % (self._local_path, server.errorString())
+            )
+        server.newConnection.connect(lambda: self._on_new_connection(server))
+        self._local_server = server
+        print("KLayout JSON server listening on local socket %s" % self._local_path)
 
     def stop(self):
         for sock in list(self._buffers.keys()):
             try:
-                sock.disconnectFromHost()
+                if isinstance(sock, pya.QLocalSocket):
+                    sock.disconnectFromServer()
+                else:
+                    sock.disconnectFromHost()
             except Exception:
                 pass
         self._buffers = {}
+        self._inbound = {}
+        self._outbound = {}
+        self._ready.clear()
+        self._work_timer.stop()
+        self._layout_watcher.stop()
+        self._layout_subscribers.clear()
+        self._expire_timer.stop()
+        _SHARED_BUFFERS.clear()
         self._server.close()
+        if self._local_server is not None:
+            self._local_server.close()
+            self._local_server = None
 
-    def _on_new_connection(self):
-        while self._server.hasPendingConnections():
-            sock = self._server.nextPendingConnection()
+    def _on_new_connection(self, server):
+        while server.hasPendingConnections():
+            sock = server.nextPendingConnection()
+            sock.setReadBufferSize(READ_BUFFER_LIMIT)
             self._buffers[sock] = bytearray()
+            self._inbound[sock] = _Inbound(self._rate_limit)
+            self._outbound[sock] = _Outbound()
             sock.readyRead.connect(lambda s=sock: self._on_ready_read(s))
+            sock.bytesWritten.connect(lambda _n, s=sock: self._flush_outbound(s))
             sock.disconnected.connect(lambda s=sock: self._on_disconnected(s))
 
     def _on_disconnected(self, sock):
         if sock in self._buffers:
             del self._buffers[sock]
+        self._inbound.pop(sock, None)
+        self._outbound.pop(sock, None)
         if sock in self._selection_subscribers:
             self._selection_subscribers.discard(sock)
             if not self._selection_subscribers:
                 self._selection_timer.stop()
+        if sock in self._layout_subscribers:
+            self._unsubscribe_layout_changes(sock)
         try:
             sock.deleteLater()
         except Exception:
@@ -59,24 +290,82 @@ class _JsonTcpServer(object):
 
     def _on_ready_read(self, sock):
         try:
-            data = sock.readAll()
-            if data is None:
-                return
-            self._buffers[sock].extend(bytes(data))
-            buffer = self._buffers[sock]
-            while True:
-                idx = buffer.find(b"\n")
-                if idx < 0:
-                    break
-                line = bytes(buffer[:idx]).strip()
-                del buffer[: idx + 1]
-                if not line:
-                    continue
-                self._handle_line(sock, line)
+            self._fill_requests(sock)
         except Exception:
             self._send_error(sock, None, traceback.format_exc())
+            return
+        inbound = self._inbound.get(sock)
+        if inbound is not None and inbound.requests and sock not in self._ready:
+            self._ready.append(sock)
+            self._work_timer.start(0)
+
+    def _fill_requests(self, sock):
+        """Move complete lines into the request queue, up to max_pending.
+
+        Socket data is only read once buffered lines are used up, so a
+        flooding client is held back by Qt's read buffer and TCP.
+        """
+        inbound = self._inbound.get(sock)
+        if inbound is None:
+            return
+        buffer = self._buffers[sock]
+        self._split_lines(inbound, buffer)
+        if len(inbound.requests) >= self._max_pending:
+            return
+        data = sock.readAll()
+        if data is None:
+            return
+        buffer.extend(bytes(data))
+        self._split_lines(inbound, buffer)
 
-    def _handle_line(self, sock, line):
+    def _split_lines(self, inbound, buffer):
+        while len(inbound.requests) < self._max_pending:
+            idx = buffer.find(b"\n")
+            if idx < 0:
+                break
+            line = bytes(buffer[:idx]).strip()
+            del buffer[: idx + 1]
+            if line:
+                inbound.requests.append((line, time.monotonic()))
+
+    def _process_slice(self):
+        """Handle queued requests round-robin until the time slice is used up."""
+        deadline = time.monotonic() + self._slice_seconds
+        limited = 0
+        wait = None
+        while self._ready and limited < len(self._ready):
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            sock = self._ready.popleft()
+            inbound = self._inbound.get(sock)
+            if inbound is None or not inbound.requests:
+                continue
+            if not inbound.take(now):
+                self._ready.append(sock)
+                limited += 1
+                delay = inbound.wait_seconds()
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            limited = 0
+            line, received_at = inbound.requests.popleft()
+            try:
+                self._handle_line(sock, line, received_at)
+                if sock in self._inbound:
+                    self._fill_requests(sock)
+            except Exception:
+                self._send_error(sock, None, traceback.format_exc())
+            if inbound.requests and sock in self._inbound:
+                self._ready.append(sock)
+        if not self._ready:
+            return
+        if limited and limited >= len(self._ready):
+            # Every queued connection is rate limited: sleep until a token is due.
+            self._work_timer.start(int(math.ceil((wait or 0.0) * 1000)))
+        else:
+            self._work_timer.start(0)
+
+    def _handle_line(self, sock, line, received_at=None):
         try:
             req = json.loads(line.decode("utf-8"))
         except Exception:
@@ -85,27 +374,72 @@ class _JsonTcpServer(object):
         req_id = req.get("id")
         method = req.get("method")
         params = req.get("params") or {}
+        trace = req.get("trace")
+        started = time.monotonic()
         try:
             result = self._dispatch(sock, method, params)
-            self._send_ok(sock, req_id, result)
+            resp = {"id": req_id, "ok": True, "result": result}
         except Exception as exc:
-            self._send_error(sock, req_id, str(exc))
-
-    def _send_ok(self, sock, req_id, result):
-        resp = {"id": req_id, "ok": True, "result": result}
+            resp = {"id": req_id, "ok": False, "error": str(exc)}
+        if isinstance(trace, dict):
+            resp["trace"] = _record_span(trace, method, received_at or started, started, resp)
         self._send(sock, resp)
 
     def _send_error(self, sock, req_id, message):
         resp = {"id": req_id, "ok": False, "error": message}
         self._send(sock, resp)
 
-    def _send(self, sock, resp):
+    def _send(self, sock, resp, coalesce_key=None):
+        out = self._outbound.get(sock)
+        if out is None:
+            return
         payload = (json.dumps(resp) + "\n").encode("utf-8")
+        if coalesce_key is None:
+            out.queue.append(payload)
+            out.queued_bytes += len(payload)
+        else:
+            # Only the newest event of this kind is worth delivering.
+            out.latest.pop(coalesce_key, None)
+            out.latest[coalesce_key] = payload
+        self._flush_outbound(sock)
+
+    def _flush_outbound(self, sock):
+        out = self._outbound.get(sock)
+        if out is None:
+            return
         try:
-            sock.write(payload)
+            while out.queue or out.latest:
+                if sock.bytesToWrite() >= OUTBOUND_SOFT_LIMIT:
+                    break
+                if out.queue:
+                    payload = out.queue.popleft()
+                    out.queued_bytes -= len(payload)
+                else:
+                    _, payload = out.latest.popitem(last=False)
+                sock.write(payload)
             sock.flush()
+            over = sock.bytesToWrite() >= OUTBOUND_SOFT_LIMIT
+        except Exception:
+            return
+        if not over:
+            out.over_since = None
+            return
+        now = time.monotonic()
+        if out.over_since is None:
+            out.over_since = now
+        if out.pending_bytes() > OUTBOUND_HARD_LIMIT:
+            self._drop_connection(sock, "outbound queue over %d bytes" % OUTBOUND_HARD_LIMIT)
+        elif now - out.over_since > OUTBOUND_STALL_SECONDS:
+            self._drop_connection(sock, "stalled for %.0fs" % OUTBOUND_STALL_SECONDS)
+
+    def _drop_connection(self, sock, reason):
+        print("KLayout JSON TCP server: dropping slow client (%s)" % reason)
+        try:
+            sock.abort()
         except Exception:
             pass
+        if sock in self._buffers:
+            self._on_disconnected(sock)
 
     def _subscribe_selection(self, sock):
         self._selection_subscribers.add(sock)
@@ -160,34 +494,158 @@ class _JsonTcpServer(object):
             if sock not in self._buffers:
                 self._selection_subscribers.discard(sock)
                 continue
-            self._send(sock, payload)
+            self._send(sock, payload, coalesce_key="selection")
 
     def _on_selection_tick(self):
         if not self._selection_subscribers:
             return
         self._notify_selection()
 
+    def _subscribe_layout_changes(self, sock):
+        if not self._layout_subscribers:
+            self._layout_watcher.start()
+        self._layout_subscribers.add(sock)
+        return {"subscribed": True, "generation": _GENERATION.current()}
+
+    def _unsubscribe_layout_changes(self, sock):
+        self._layout_subscribers.discard(sock)
+        if not self._layout_subscribers:
+            self._layout_watcher.stop()
+        return {"subscribed": False}
+
+    def _notify_layout_change(self, payload):
+        for sock in list(self._layout_subscribers):
+            if sock not in self._buffers:
+                self._layout_subscribers.discard(sock)
+                continue
+            # A client that falls behind only gets the newest event; a gap in
+            # "generation" tells it to re-fetch instead of applying deltas.
+            self._send(sock, payload, coalesce_key="layout")
+
     def _dispatch(self, sock, method, params):
         if method == "ping":
             return {"message": "pong"}
         if method == "shutdown":
             self.stop()
             return {"message": "server stopped"}
-        if method == "open_layout":
-            return _open_layout(params)
-        if method == "load_gds":
-            return _load_gds(params)
-        if method == "get_cell_list":
-            return _get_cell_list(params)
-        if method == "export_gds":
-            return _export_gds(params)
+        if method in _TOOL_HANDLERS:
+            return _TOOL_HANDLERS[method](params)
         if method == "subscribe_selection":
             return self._subscribe_selection(sock)
         if method == "unsubscribe_selection":
             return self._unsubscribe_selection(sock)
+        if method == "subscribe_layout_changes":
+            return self._subscribe_layout_changes(sock)
+        if method == "unsubscribe_layout_changes":
+            return self._unsubscribe_layout_changes(sock)
         raise RuntimeError("Unknown method: %s" % method)
 
 
+def _record_span(trace, method, received_at, started, resp):
+    """Time one traced request; append it to TRACE_PATH and return the timings."""
+    finished = time.monotonic()
+    span_id = os.urandom(8).hex()
+    timing = {
+        "trace_id": trace.get("trace_id"),
+        "span_id": span_id,
+        "queue_ms": round((started - received_at) * 1000.0, 3),
+        "handle_ms": round((finished - started) * 1000.0, 3),
+    }
+    if TRACE_PATH:
+        end_ns = time.time_ns()
+        record = {
+            "traceId": trace.get("trace_id"),
+            "spanId": span_id,
+            "parentSpanId": trace.get("span_id"),
+            "name": "klayout.%s" % method,
+            "kind": "SERVER",
+            "startTimeUnixNano": end_ns - int((finished - received_at) * 1e9),
+            "endTimeUnixNano": end_ns,
+            "attributes": {
+                "rpc.method": method,
+                "klayout.queue_ms": timing["queue_ms"],
+                "klayout.handle_ms": timing["handle_ms"],
+                "klayout.generation": _GENERATION.value,
+            },
+            "status": {"code": "OK"} if resp.get("ok") else
+                      {"code": "ERROR", "message": resp.get("error")},
+            "resource": {"service.name": "klayout-tcp-server"},
+        }
+        try:
+            with open(TRACE_PATH, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        except (IOError, OSError):
+            pass
+    return timing
+
+
+class _LayoutGeneration(object):
+    """Counter that changes whenever the active layout may have changed.
+
+    Mutating handlers bump it explicitly; switching views/cellviews, a
+    change in the cell count and GUI edits that change the layer list, a
+    shape count of the active cell or its bounding box are detected when
+    the counter is read (see _layout_change_signature).
+    """
+
+    def __init__(self):
+        self.value = 0
+        self._identity = None
+
+    def bump(self):
+        self.value += 1
+        return self.value
+
+    def current(self):
+        identity = _active_layout_identity()
+        if identity != self._identity:
+            self._identity = identity
+            self.value += 1
+        return self.value
+
+
+_GENERATION = _LayoutGeneration()
+
+
+def _active_layout_identity():
+    mw = _get_main_window()
+    if mw is None:
+        return None
+    view = mw.current_view()
+    if view is None:
+        return None
+    cv = view.active_cellview()
+    if cv is None or not cv.is_valid():
+        return (mw.current_view_index(), None)
+    layout = cv.layout()
+    return (
+        mw.current_view_index(),
+        cv.index(),
+        cv.filename(),
+        layout.cells(),
+        _layout_change_signature(layout, cv.cell),
+    )
+
+
+def _layout_change_signature(layout, cell):
+    """Cheap fingerprint of in-place edits, read on every generation check.
+
+    Layer list, per-layer shape counts of the active cell and its bounding
+    box (which covers the whole hierarchy below it). Edits that keep all of
+    these, e.g. reshaping a polygon inside a child cell, still go unseen
+    unless a mutating handler or the layout watcher bumps the generation.
+    """
+    layers = []
+    for layer_index in layout.layer_indexes():
+        info = layout.get_info(layer_index)
+        count = cell.shapes(layer_index).size() if cell is not None else 0
+        layers.append((info.layer, info.datatype, count))
+    if cell is None:
+        return tuple(layers), None
+    box = cell.bbox()
+    return tuple(layers), (box.left, box.bottom, box.right, box.top), cell.child_instances()
+
+
 def _get_main_window():
     app = pya.Application.instance()
     return app.main_window() if app else None
@@ -211,6 +669,308 @@ def _require_layout():
     return cv.layout()
 
 
+class _LayoutWatcher(object):
+    """Coalesced change summaries for the active layout.
+
+    View signals (file opened, cellviews or layer list changed, view
+    switched) and a periodic poll only mark the watcher dirty; once per
+    event loop turn the per-cell, per-layer shape counts are compared with
+    the previous snapshot and one summary is reported. Edits that move
+    shapes without changing any count are only seen through the signals.
+    """
+
+    _VIEW_EVENTS = (
+        "on_file_open",
+        "on_cellviews_changed",
+        "on_cellview_changed",
+        "on_active_cellview_changed",
+        "on_layer_list_changed",
+    )
+
+    def __init__(self, parent, on_change):
+        self._on_change = on_change
+        self._reasons = set()
+        self._snapshot = None
+        self._view = None
+        self._main_window = None
+        self._handlers = []
+        self._flush_timer = pya.QTimer(parent)
+        self._flush_timer.setSingleShot(True)
+        self._flush_timer.setInterval(0)
+        self._flush_timer.timeout.connect(self._flush)
+        self._poll_timer = pya.QTimer(parent)
+        self._poll_timer.setInterval(LAYOUT_WATCH_POLL_MS)
+        self._poll_timer.timeout.connect(self._flush)
+
+    def start(self):
+        self._snapshot = _layout_snapshot()
+        self._bind()
+        self._poll_timer.start()
+
+    def stop(self):
+        self._poll_timer.stop()
+        self._flush_timer.stop()
+        self._unbind()
+        self._snapshot = None
+        self._reasons = set()
+
+    def note(self, reason):
+        self._reasons.add(reason)
+        if not self._flush_timer.isActive():
+            self._flush_timer.start()
+
+    def _connect(self, obj, name, handler):
+        try:
+            event = getattr(obj, name)
+            event += handler
+            setattr(obj, name, event)
+            self._handlers.append((obj, name, handler))
+        except Exception:
+            pass
+
+    def _bind(self):
+        mw = _get_main_window()
+        if mw is not None and mw is not self._main_window:
+            self._main_window = mw
+            self._connect(mw, "on_current_view_changed", lambda *args: self.note("view_changed"))
+        view = mw.current_view() if mw is not None else None
+        if view is self._view:
+            return
+        self._unbind(keep_main_window=True)
+        self._view = view
+        if view is None:
+            return
+        for name in self._VIEW_EVENTS:
+            self._connect(view, name, lambda *args, reason=name[3:]: self.note(reason))
+
+    def _unbind(self, keep_main_window=False):
+        kept = []
+        for obj, name, handler in self._handlers:
+            if keep_main_window and obj is self._main_window:
+                kept.append((obj, name, handler))
+                continue
+            try:
+                event = getattr(obj, name)
+                event -= handler
+                setattr(obj, name, event)
+            except Exception:
+                pass
+        self._handlers = kept
+        self._view = None
+        if not keep_main_window:
+            self._main_window = None
+
+    def _flush(self):
+        reasons = sorted(self._reasons)
+        self._reasons = set()
+        self._bind()
+        previous = self._snapshot
+        self._snapshot = _layout_snapshot()
+        summary = _diff_layout_snapshots(previous, self._snapshot)
+        if summary is None:
+            if not reasons:
+                return
+            generation = _GENERATION.current()
+            summary = _diff_layout_snapshots(self._snapshot, self._snapshot, force=True)
+        else:
+            # Reading syncs the identity (and may already count this change),
+            # so the next read does not bump again.
+            before = _GENERATION.value
+            generation = _GENERATION.current()
+            if generation == before:
+                generation = _GENERATION.bump()
+            if "content_changed" not in reasons and not summary.get("reset"):
+                reasons.append("content_changed")
+        payload = {"event": "layout_changed", "generation": generation, "reasons": reasons}
+        payload.update(summary)
+        self._on_change(payload)
+
+
+def _layout_snapshot():
+    """Instance and per-layer shape counts of every cell of the active layout.
+
+    Above LAYOUT_WATCH_MAX_ENTRIES only cell names and layers are kept.
+    """
+    identity = _active_layout_identity()
+    try:
+        layout = _require_layout()
+    except Exception:
+        return {"identity": identity and identity[:3], "layers": [], "cells": {}}
+    layer_indexes = list(layout.layer_indexes())
+    layers = []
+    for layer_index in layer_indexes:
+        info = layout.get_info(layer_index)
+        layers.append("%s/%s" % (info.layer, info.datatype))
+    counted = layout.cells() * max(len(layer_indexes), 1) <= LAYOUT_WATCH_MAX_ENTRIES
+    cells = {}
+    for cell in _iter_cells(layout):
+        if counted:
+            cells[cell.name] = (cell.child_instances(),) + tuple(
+                cell.shapes(layer_index).size() for layer_index in layer_indexes
+            )
+        else:
+            cells[cell.name] = None
+    return {"identity": identity and identity[:3], "layers": layers, "cells": cells}
+
+
+def _name_list(names):
+    names = sorted(names)
+    return names[:LAYOUT_EVENT_MAX_NAMES], len(names) > LAYOUT_EVENT_MAX_NAMES
+
+
+def _diff_layout_snapshots(old, new, force=False):
+    """Added/removed/changed cells and layers; None if nothing differs.
+
+    "reset" means a different layout is active now and clients should
+    re-fetch instead of applying the summary.
+    """
+    reset = old is None or old["identity"] != new["identity"]
+    if reset:
+        old = {"layers": [], "cells": {}}
+    old_layers = dict(zip(old["layers"], range(len(old["layers"]))))
+    new_layers = dict(zip(new["layers"], range(len(new["layers"]))))
+    changed_cells = set()
+    changed_layers = set()
+    for name, counts in new["cells"].items():
+        before = old["cells"].get(name)
+        if name not in old["cells"] or counts is None or before is None or counts == before:
+            continue
+        changed_cells.add(name)
+        for layer, position in new_layers.items():
+            old_position = old_layers.get(layer)
+            if old_position is not None and counts[position + 1] != before[old_position + 1]:
+                changed_layers.add(layer)
+    cells = {
+        "added": set(new["cells"]) - set(old["cells"]),
+        "removed": set(old["cells"]) - set(new["cells"]),
+        "changed": changed_cells,
+    }
+    layers = {
+        "added": set(new_layers) - set(old_layers),
+        "removed": set(old_layers) - set(new_layers),
+        "changed": changed_layers,
+    }
+    if not force and not reset and not any(cells.values()) and not any(layers.values()):
+        return None
+    summary = {"reset": reset, "truncated": False, "cells": {}, "layers": {}}
+    for key, group in (("cells", cells), ("layers", layers)):
+        for kind, names in group.items():
+            summary[key][kind], truncated = _name_list(names)
+            summary["truncated"] = summary["truncated"] or truncated
+    return summary
+
+
+class _LoadedFiles(object):
+    """File signatures seen by open_layout / load_gds, for skip-if-unchanged."""
+
+    def __init__(self):
+        self.opened = {}
+        self.read = None
+
+
+_LOADED = _LoadedFiles()
+_FILE_LAYOUTS = _LruCache(FILE_LAYOUT_CACHE_SIZE)
+
+
+def _file_signature(path, check="mtime"):
+    """(abs path, size, mtime_ns) or, with check == "hash", (abs path, size, sha1)."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    if check == "hash":
+        digest = hashlib.sha1()
+        with open(path, "rb") as handle:
+            for chunk in iter(lambda: handle.read(1 << 20), b""):
+                digest.update(chunk)
+        return (path, st.st_size, digest.hexdigest())
+    return (path, st.st_size, st.st_mtime_ns)
+
+
+def _layout_cache_path(signature):
+    if not LAYOUT_CACHE_DIR:
+        return None
+    key = hashlib.sha1(repr(signature).encode("utf-8")).hexdigest()
+    return os.path.join(LAYOUT_CACHE_DIR, key + ".oas")
+
+
+def _write_layout_cache(layout, cache_path):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+        options = pya.SaveLayoutOptions()
+        options.format = "OASIS"
+        options.oasis_compression_level = 2
+        layout.write(tmp_path, options)
+        os.replace(tmp_path, cache_path)
+    except Exception:
+        print("KLayout JSON TCP server: could not write layout cache %s" % cache_path)
+        return
+    # Trimming is housekeeping; it must not fail the load that triggered it.
+    try:
+        _trim_layout_cache()
+    except Exception as e:
+        print("KLayout JSON TCP server: could not trim layout cache: %s" % e)
+
+
+def _trim_layout_cache():
+    entries = []
+    for name in os.listdir(LAYOUT_CACHE_DIR):
+        if name.endswith(".oas"):
+            full = os.path.join(LAYOUT_CACHE_DIR, name)
+            try:
+                st = os.stat(full)
+            except OSError:
+                # Removed by another process meanwhile.
+                continue
+            entries.append((st.st_mtime, st.st_size, full))
+    total = sum(size for _, size, _ in entries)
+    for _, size, full in sorted(entries):
+        if total <= LAYOUT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(full)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def _read_layout_file(layout, path, signature):
+    """layout.read(path) through the on-disk OASIS cache; returns "cache" or "file".
+
+    The cache is only written when the layout was empty before reading, so
+    it never contains anything but the file's own content.
+    """
+    cache_path = _layout_cache_path(signature)
+    if cache_path and os.path.exists(cache_path):
+        layout.read(cache_path)
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass
+        return "cache"
+    was_empty = layout.cells() == 0
+    layout.read(path)
+    if cache_path and was_empty:
+        _write_layout_cache(layout, cache_path)
+    return "file"
+
+
+def _find_cellview(mw, path):
+    for view_index in range(mw.views()):
+        view = mw.view(view_index)
+        for cv_index in range(view.cellviews()):
+            cv = view.cellview(cv_index)
+            if cv.is_valid() and cv.filename() and os.path.abspath(cv.filename()) == path:
+                return view_index, view, cv_index, cv
+    return None
+
+
+def _cellview_dirty(cv):
+    try:
+        return cv.is_dirty()
+    except Exception:
+        return True
+
+
 def _open_layout(params):
     path = params.get("path")
     if not path:
@@ -220,13 +980,25 @@ def _open_layout(params):
     mw = _get_main_window()
     if mw is None:
         raise RuntimeError("No KLayout main window (GUI required)")
+    signature = _file_signature(path, params.get("check", "mtime"))
+    if not params.get("force") and _LOADED.opened.get(signature[0]) == signature:
+        found = _find_cellview(mw, signature[0])
+        if found is not None and not _cellview_dirty(found[3]):
+            view_index, view, cv_index, _ = found
+            mw.select_view(view_index)
+            view.active_cellview_index = cv_index
+            return {"opened": True, "skipped": True}
     cellview_index = int(params.get("cellview_index", 0))
     if hasattr(mw, "load_layout"):
         result = mw.load_layout(path, cellview_index)
+        _LOADED.opened[signature[0]] = signature
+        _GENERATION.bump()
         return {"opened": True, "result": str(result)}
     view = mw.create_layout(0)
     view.load_layout(path, cellview_index)
     view.show()
+    _LOADED.opened[signature[0]] = signature
+    _GENERATION.bump()
     return {"opened": True, "view": "new"}
 
 
@@ -237,8 +1009,17 @@ def _load_gds(params):
     if not os.path.exists(path):
         raise RuntimeError("File not found: %s" % path)
     layout = _require_layout()
-    layout.read(path)
-    return {"loaded": True, "cells": layout.cells()}
+    signature = _file_signature(path, params.get("check", "mtime"))
+    if (
+        not params.get("force")
+        and _LOADED.read is not None
+        and _LOADED.read == (signature, _GENERATION.current())
+    ):
+        return {"loaded": True, "skipped": True, "cells": layout.cells()}
+    source = _read_layout_file(layout, path, signature)
+    _GENERATION.bump()
+    _LOADED.read = (signature, _GENERATION.current())
+    return {"loaded": True, "cells": layout.cells(), "source": source}
 
 
 def _iter_cells(layout):
@@ -258,7 +1039,347 @@ def _get_cell_list(params):
             names.append(cell.name)
         except Exception:
             pass
-    return {"cells": sorted(set(names))}
+    names = sorted(set(names))
+    if params.get("shm"):
+        return {"count": len(names), "shared": _SHARED_BUFFERS.publish(_string_arrays(names))}
+    return {"cells": names}
+
+
+class _CellTreeIndex(object):
+    """Per-generation memo of cell node summaries and child lists."""
+
+    def __init__(self):
+        self.generation = None
+        self._nodes = {}
+        self._children = {}
+
+    def reset(self, generation):
+        if generation != self.generation:
+            self.generation = generation
+            self._nodes = {}
+            self._children = {}
+
+    def node(self, layout, cell_index):
+        node = self._nodes.get(cell_index)
+        if node is None:
+            cell = layout.cell(cell_index)
+            box = cell.dbbox()
+            node = {
+                "name": cell.name,
+                "children": cell.child_cells(),
+                "instances": cell.child_instances(),
+                "parents": cell.parent_cells(),
+                "bbox": None if box.empty() else [box.left, box.bottom, box.right, box.top],
+            }
+            self._nodes[cell_index] = node
+        return node
+
+    def children(self, layout, cell_index):
+        children = self._children.get(cell_index)
+        if children is None:
+            cell = layout.cell(cell_index)
+            children = sorted(cell.each_child_cell(), key=lambda ci: layout.cell(ci).name)
+            self._children[cell_index] = children
+        return children
+
+
+_CELL_TREE = _CellTreeIndex()
+
+
+def _cell_tree(params):
+    """Return top cells (or the given cell) expanded to ``depth`` levels.
+
+    Each node carries child-cell and instance counts, parent count and bbox
+    (microns); unexpanded nodes can be fetched later with ``cell``.
+    """
+    layout = _require_layout()
+    _CELL_TREE.reset(_GENERATION.current())
+    depth = int(params.get("depth", 1 if params.get("cell") else 0))
+    if params.get("cell"):
+        cell = layout.cell(params["cell"])
+        if cell is None:
+            raise RuntimeError("Cell not found: %s" % params["cell"])
+        roots = [cell.cell_index()]
+    else:
+        roots = sorted(
+            (cell.cell_index() for cell in layout.top_cells()),
+            key=lambda ci: layout.cell(ci).name,
+        )
+    budget = [int(params.get("max_nodes", MAX_TREE_NODES))]
+    # Set only when a node is left out, not when the budget is merely used up.
+    truncated = [False]
+
+    def expand(cell_index, level):
+        node = dict(_CELL_TREE.node(layout, cell_index))
+        budget[0] -= 1
+        if level > 0 and node["children"]:
+            node["child_nodes"] = []
+            for child in _CELL_TREE.children(layout, cell_index):
+                if budget[0] <= 0:
+                    truncated[0] = True
+                    break
+                node["child_nodes"].append(expand(child, level - 1))
+        return node
+
+    nodes = []
+    for root in roots:
+        if budget[0] <= 0:
+            truncated[0] = True
+            break
+        nodes.append(expand(root, depth))
+    return {"generation": _CELL_TREE.generation, "nodes": nodes, "truncated": truncated[0]}
+
+
+class _SpatialIndex(object):
+    """Uniform grid over the flattened shapes of one (cell, layer).
+
+    Built once from a recursive shape iteration; point and box queries
+    only look at the grid cells they touch.
+    """
+
+    def __init__(self, layout, cell, layer_index):
+        info = layout.get_info(layer_index)
+        self.layer = "%s/%s" % (info.layer, info.datatype)
+        self.polygons = []
+        self.boxes = []
+        it = cell.begin_shapes_rec(layer_index)
+        while not it.at_end():
+            shape = it.shape()
+            if shape.is_polygon() or shape.is_box() or shape.is_path():
+                poly = shape.polygon.transformed(it.trans())
+                self.polygons.append(poly)
+                self.boxes.append(poly.bbox())
+            it.next()
+
+        extent = pya.Box()
+        for box in self.boxes:
+            extent += box
+        count = max(len(self.boxes), 1)
+        area = max(extent.width(), 1) * max(extent.height(), 1)
+        # Aim for a few shapes per grid cell.
+        self.pitch = max(int(math.sqrt(4.0 * area / count)), 1)
+        self.grid = {}
+        self.large = []
+        for index, box in enumerate(self.boxes):
+            x0, y0, x1, y1 = self._span(box)
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > SPATIAL_MAX_CELLS_PER_SHAPE:
+                self.large.append(index)
+                continue
+            for gx in range(x0, x1 + 1):
+                for gy in range(y0, y1 + 1):
+                    self.grid.setdefault((gx, gy), []).append(index)
+
+    def _span(self, box):
+        pitch = self.pitch
+        return box.left // pitch, box.bottom // pitch, box.right // pitch, box.top // pitch
+
+    def at_point(self, point, limit):
+        found = []
+        key = (point.x // self.pitch, point.y // self.pitch)
+        for index in self.grid.get(key, []) + self.large:
+            if self.boxes[index].contains(point) and self.polygons[index].inside(point):
+                found.append(index)
+                if len(found) >= limit:
+                    break
+        return found
+
+    def touching(self, box, limit):
+        x0, y0, x1, y1 = self._span(box)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.grid):
+            buckets = [
+                bucket
+                for (gx, gy), bucket in self.grid.items()
+                if x0 <= gx <= x1 and y0 <= gy <= y1
+            ]
+        else:
+            buckets = [
+                self.grid.get((gx, gy), [])
+                for gx in range(x0, x1 + 1)
+                for gy in range(y0, y1 + 1)
+            ]
+        buckets.append(self.large)
+        seen = set()
+        found = []
+        for bucket in buckets:
+            for index in bucket:
+                if index in seen:
+                    continue
+                seen.add(index)
+                if not self.boxes[index].touches(box):
+                    continue
+                if not self.boxes[index].inside(box) and not _polygon_touches(
+                    self.polygons[index], box
+                ):
+                    continue
+                found.append(index)
+                if len(found) >= limit:
+                    return found
+        return found
+
+    def describe(self, index):
+        box = self.boxes[index]
+        return {
+            "layer": self.layer,
+            "bbox": [box.left, box.bottom, box.right, box.top],
+            "polygon": _polygon_string(self.layer, self.polygons[index]),
+        }
+
+
+def _polygon_touches(poly, box):
+    try:
+        return poly.touches(box)
+    except AttributeError:
+        return not (pya.Region(poly) & pya.Region(box)).is_empty()
+
+
+class _SpatialIndexCache(object):
+    """Flattened indexes, dropped on a new generation or a changed hierarchy.
+
+    The generation only fingerprints the active cell, so each index also
+    keeps _hierarchy_signature of the cells it was built from.
+    """
+
+    def __init__(self, max_entries=SPATIAL_INDEX_CACHE_SIZE):
+        self.generation = None
+        self._indexes = _LruCache(max_entries)
+
+    def get(self, layout, cell, layer_index):
+        generation = _GENERATION.current()
+        if generation != self.generation:
+            self.generation = generation
+            self._indexes.clear()
+        key = (cell.cell_index(), layer_index)
+        signature = _hierarchy_signature(layout, cell, layer_index)
+        entry = self._indexes.get(key)
+        built = entry is None or entry[0] != signature
+        if built:
+            entry = (signature, _SpatialIndex(layout, cell, layer_index))
+            self._indexes.put(key, entry)
+        return entry[1], built
+
+
+def _hierarchy_signature(layout, cell, layer_index):
+    """Shape count, instance count and layer bbox of cell and every cell below it."""
+    signature = []
+    for cell_index in [cell.cell_index()] + list(cell.called_cells()):
+        member = layout.cell(cell_index)
+        box = member.bbox(layer_index)
+        signature.append((
+            cell_index,
+            member.shapes(layer_index).size(),
+            member.child_instances(),
+            box.left,
+            box.bottom,
+            box.right,
+            box.top,
+        ))
+    return tuple(signature)
+
+
+_SPATIAL_INDEXES = _SpatialIndexCache()
+
+
+def _pick_targets(params):
+    layout = _require_layout()
+    view = _require_view()
+    if params.get("cell"):
+        cell = layout.cell(params["cell"])
+        if cell is None:
+            raise RuntimeError("Cell not found: %s" % params["cell"])
+    else:
+        cell = view.active_cellview().cell
+    if params.get("layer"):
+        key = _parse_layer_spec(params["layer"])
+        layer_index = _layer_indexes_by_info(layout).get(key)
+        if layer_index is None:
+            raise RuntimeError("Layer not found: %s" % params["layer"])
+        layer_indexes = [layer_index]
+    else:
+        layer_indexes = list(layout.layer_indexes())
+    return layout, cell, layer_indexes
+
+
+def _run_pick(params, query, default_limit):
+    layout, cell, layer_indexes = _pick_targets(params)
+    limit = int(params.get("limit", default_limit))
+    start = time.perf_counter()
+    hits = []
+    built = False
+    for layer_index in layer_indexes:
+        index, fresh = _SPATIAL_INDEXES.get(layout, cell, layer_index)
+        built = built or fresh
+        hits.extend((index, found) for found in query(layout, index, limit - len(hits)))
+        if len(hits) >= limit:
+            break
+    result = {
+        "cell": cell.name,
+        "dbu": layout.dbu,
+        "index_built": built,
+    }
+    if params.get("shm"):
+        result["count"] = len(hits)
+        result["shared"] = _SHARED_BUFFERS.publish(_polygon_arrays(
+            [index.polygons[found] for index, found in hits],
+            [_parse_layer_spec(index.layer) for index, found in hits],
+        ))
+    else:
+        result["shapes"] = [index.describe(found) for index, found in hits]
+    result["elapsed_ms"] = round((time.perf_counter() - start) * 1000.0, 3)
+    return result
+
+
+def _pick(params):
+    """Shapes containing the point (x, y) in microns, optionally on one layer."""
+    if "x" not in params or "y" not in params:
+        raise RuntimeError("x and y are required")
+
+    def query(layout, index, limit):
+        point = pya.DPoint(float(params["x"]), float(params["y"])).to_itype(layout.dbu)
+        return index.at_point(point, limit)
+
+    return _run_pick(params, query, 10)
+
+
+def _shapes_touching(params):
+    """Shapes touching bbox [x1, y1, x2, y2] in microns, optionally on one layer."""
+    if not params.get("bbox"):
+        raise RuntimeError("bbox is required")
+
+    def query(layout, index, limit):
+        box = pya.DBox(*params["bbox"]).to_itype(layout.dbu)
+        return index.touching(box, limit)
+
+    return _run_pick(params, query, 1000)
+
+
+def _layer_polygons(params):
+    """All polygons (hulls, flattened) on one layer of a cell.
+
+    Paged JSON by default; with "shm": true the coordinates come back as
+    shared arrays (coords, offsets, bboxes) in database units.
+    """
+    if not params.get("layer"):
+        raise RuntimeError("layer is required")
+    layout, cell, layer_indexes = _pick_targets(params)
+    index, built = _SPATIAL_INDEXES.get(layout, cell, layer_indexes[0])
+    result = {
+        "cell": cell.name,
+        "layer": index.layer,
+        "dbu": layout.dbu,
+        "count": len(index.polygons),
+        "index_built": built,
+    }
+    if params.get("shm"):
+        result["shared"] = _SHARED_BUFFERS.publish(_polygon_arrays(index.polygons))
+        return result
+    items = [{"layer": index.layer, "hull": _polygon_hull(poly)} for poly in index.polygons]
+    token = _RESULTS.store(items, params.get("page_size", RESULT_PAGE_SIZE))
+    result.update(_RESULTS.page(token, 0))
+    return result
+
+
+def _layout_generation(params):
+    return {"generation": _GENERATION.current()}
 
 
 def _export_gds(params):
@@ -273,6 +1394,693 @@ def _export_gds(params):
     return {"exported": True, "path": path}
 
 
+class _PagedResults(object):
+    """Large results stay server-side; replies carry one page plus a token."""
+
+    def __init__(self, max_results=MAX_STORED_RESULTS):
+        self._results = collections.OrderedDict()
+        self._max_results = max_results
+        self._counter = 0
+
+    def store(self, items, page_size=RESULT_PAGE_SIZE):
+        self._counter += 1
+        token = "r%d" % self._counter
+        self._results[token] = (items, max(int(page_size), 1))
+        while len(self._results) > self._max_results:
+            self._results.popitem(last=False)
+        return token
+
+    def page(self, token, index=0):
+        entry = self._results.get(token)
+        if entry is None:
+            raise RuntimeError("Unknown or expired result token: %s" % token)
+        self._results.move_to_end(token)
+        items, page_size = entry
+        pages = max(1, int(math.ceil(len(items) / float(page_size))))
+        index = int(index)
+        if index < 0 or index >= pages:
+            raise RuntimeError("Page %s out of range (0..%s)" % (index, pages - 1))
+        start = index * page_size
+        return {
+            "token": token,
+            "page": index,
+            "pages": pages,
+            "items": items[start : start + page_size],
+        }
+
+
+_RESULTS = _PagedResults()
+
+
+def _fetch_page(params):
+    token = params.get("token")
+    if not token:
+        raise RuntimeError("token is required")
+    return _RESULTS.page(token, params.get("page", 0))
+
+
+_ARRAY_DTYPES = {"B": "uint8", "i": "int32", "q": "int64", "f": "float32", "d": "float64"}
+
+
+class _SharedBuffers(object):
+    """Result arrays handed to local clients through mapped files.
+
+    Each handle is one file (user-only) holding its arrays back to back at
+    8-byte aligned offsets; the reply only describes them. Clients map the
+    file read-only, so nothing is serialized. Files are removed on
+    release_buffer, after SHARED_BUFFER_TTL, or oldest-first above
+    SHARED_BUFFER_MAX_BYTES; existing mappings stay valid after removal.
+    """
+
+    def __init__(self, directory=SHARED_BUFFER_DIR, ttl=SHARED_BUFFER_TTL,
+                 max_bytes=SHARED_BUFFER_MAX_BYTES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._buffers = collections.OrderedDict()
+        self._bytes = 0
+
+    def publish(self, arrays):
+        """arrays: [(name, array.array, shape), ...]; returns the reply descriptor."""
+        self.expire()
+        handle = "klayout-%d-%s" % (os.getpid(), os.urandom(6).hex())
+        path = os.path.join(self.directory, handle)
+        specs = {}
+        offset = 0
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            for name, data, shape in arrays:
+                pad = -offset % 8
+                if pad:
+                    f.write(b"\0" * pad)
+                    offset += pad
+                f.write(data.tobytes())
+                specs[name] = {
+                    "dtype": _ARRAY_DTYPES[data.typecode],
+                    "shape": list(shape),
+                    "offset": offset,
+                }
+                offset += len(data) * data.itemsize
+        self._buffers[handle] = (path, offset, time.monotonic() + self.ttl)
+        self._bytes += offset
+        while self._bytes > self.max_bytes and len(self._buffers) > 1:
+            self.release(next(iter(self._buffers)))
+        return {"handle": handle, "path": path, "size": offset, "ttl": self.ttl, "arrays": specs}
+
+    def release(self, handle):
+        entry = self._buffers.pop(handle, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[1]
+        try:
+            os.remove(entry[0])
+        except OSError:
+            pass
+        return True
+
+    def expire(self):
+        now = time.monotonic()
+        for handle in [h for h, entry in self._buffers.items() if entry[2] <= now]:
+            self.release(handle)
+
+    def clear(self):
+        for handle in list(self._buffers):
+            self.release(handle)
+
+
+_SHARED_BUFFERS = _SharedBuffers()
+
+
+def _release_buffer(params):
+    handle = params.get("handle")
+    if not handle:
+        raise RuntimeError("handle is required")
+    return {"released": _SHARED_BUFFERS.release(handle)}
+
+
+def _polygon_arrays(polygons, layers=None):
+    """Hull points of polygons as coords [n, 2] int32 with offsets [count + 1] int64."""
+    coords = array.array("i")
+    offsets = array.array("q", [0])
+    bboxes = array.array("i")
+    for poly in polygons:
+        coords.extend(_polygon_hull(poly))
+        offsets.append(len(coords) // 2)
+        box = poly.bbox()
+        bboxes.extend((box.left, box.bottom, box.right, box.top))
+    arrays = [
+        ("coords", coords, (len(coords) // 2, 2)),
+        ("offsets", offsets, (len(offsets),)),
+        ("bboxes", bboxes, (len(polygons), 4)),
+    ]
+    if layers is not None:
+        # (layer, datatype) per polygon.
+        arrays.append(("layers", array.array("i", [n for pair in layers for n in pair]),
+                       (len(polygons), 2)))
+    return arrays
+
+
+def _string_arrays(strings):
+    """UTF-8 strings as one uint8 blob with offsets [count + 1] int64."""
+    blob = bytearray()
+    offsets = array.array("q", [0])
+    for text in strings:
+        blob += text.encode("utf-8")
+        offsets.append(len(blob))
+    return [
+        ("data", array.array("B", bytes(blob)), (len(blob),)),
+        ("offsets", offsets, (len(offsets),)),
+    ]
+
+
+def _resolve_layout_ref(ref, cell_name=None):
+    """Resolve a layout reference to (layout, cell).
+
+    ref is a file path, a cellview index of the current view, or None for
+    the active cellview. Without cell_name the cellview's cell or the
+    first top cell is used.
+    """
+    cell = None
+    if ref is None or isinstance(ref, int):
+        view = _require_view()
+        cv = view.active_cellview() if ref is None else view.cellview(int(ref))
+        if cv is None or not cv.is_valid():
+            raise RuntimeError("No such cellview: %s" % ref)
+        layout = cv.layout()
+        cell = cv.cell
+    else:
+        if not os.path.exists(ref):
+            raise RuntimeError("File not found: %s" % ref)
+        signature = _file_signature(ref)
+        layout = _FILE_LAYOUTS.get(signature)
+        if layout is None:
+            layout = pya.Layout()
+            _read_layout_file(layout, ref, signature)
+            _FILE_LAYOUTS.put(signature, layout)
+    if cell_name:
+        cell = layout.cell(cell_name)
+        if cell is None:
+            raise RuntimeError("Cell not found: %s" % cell_name)
+    if cell is None:
+        tops = layout.top_cells()
+        if not tops:
+            raise RuntimeError("Layout has no top cell: %s" % ref)
+        cell = tops[0]
+    return layout, cell
+
+
+def _layer_indexes_by_info(layout):
+    layers = {}
+    for index in layout.layer_indexes():
+        info = layout.get_info(index)
+        layers[(info.layer, info.datatype)] = index
+    return layers
+
+
+def _parse_layer_spec(spec):
+    try:
+        layer, datatype = (int(v) for v in str(spec).split("/"))
+    except ValueError:
+        raise RuntimeError("Invalid layer (expected L/D): %s" % spec)
+    return layer, datatype
+
+
+def _polygon_hull(poly):
+    if poly.holes():
+        poly = poly.resolved_holes()
+    coords = []
+    for pt in poly.each_point_hull():
+        coords.append(pt.x)
+        coords.append(pt.y)
+    return coords
+
+
+def _tiling_processor(dbu, params):
+    tile = float(params.get("tile_um", TILE_MICRONS))
+    threads = int(params.get("threads") or os.cpu_count() or 1)
+    tp = pya.TilingProcessor()
+    tp.dbu = dbu
+    tp.tile_size(tile, tile)
+    tp.threads = threads
+    return tp, tile, threads
+
+
+class _RegionCollector(pya.TileOutputReceiver):
+    """Collects per-tile counts/areas for one layer and optionally the polygons."""
+
+    def __init__(self, layer, polygons, max_items):
+        self.layer = layer
+        self.count = 0
+        self.area = 0
+        self.tiles = []
+        self.truncated = False
+        self._polygons = polygons
+        self._max_items = max_items
+
+    def put(self, ix, iy, tile, obj, dbu, clip):
+        # The script cannot AND with _tile itself: it is nil when the whole
+        # input fits into a single tile, so clipping happens here instead.
+        if clip and tile is not None:
+            obj = obj & pya.Region(tile)
+        count = obj.count()
+        if not count:
+            return
+        area = obj.area()
+        self.count += count
+        self.area += area
+        self.tiles.append(
+            {
+                "layer": self.layer,
+                "tile": [ix, iy],
+                "box": [tile.left, tile.bottom, tile.right, tile.top],
+                "count": count,
+                "area": area,
+            }
+        )
+        if self._polygons is None:
+            return
+        for poly in obj.each():
+            if len(self._polygons) >= self._max_items:
+                self.truncated = True
+                return
+            self._polygons.append({"layer": self.layer, "tile": [ix, iy], "hull": _polygon_hull(poly)})
+
+
+def _diff_layouts(params):
+    """XOR two layouts layer by layer with a multi-threaded tiling processor.
+
+    params: a / b (path, cellview index or omitted for the active cellview),
+    cell_a / cell_b, layers (["1/0", ...], default: all), mode
+    ("summary" pages per-tile counts, "polygons" pages difference polygons),
+    tile_um, threads, page_size.
+    """
+    layout_a, cell_a = _resolve_layout_ref(params.get("a"), params.get("cell_a"))
+    layout_b, cell_b = _resolve_layout_ref(params.get("b"), params.get("cell_b"))
+    mode = params.get("mode", "summary")
+    if mode not in ("summary", "polygons"):
+        raise RuntimeError("mode must be 'summary' or 'polygons'")
+
+    layers_a = _layer_indexes_by_info(layout_a)
+    layers_b = _layer_indexes_by_info(layout_b)
+    keys = sorted(set(layers_a) | set(layers_b))
+    if params.get("layers"):
+        wanted = set(_parse_layer_spec(spec) for spec in params["layers"])
+        keys = [key for key in keys if key in wanted]
+
+    tp, tile, threads = _tiling_processor(layout_a.dbu, params)
+    frame = cell_a.dbbox() + cell_b.dbbox()
+    if not frame.empty():
+        tp.frame = frame
+    polygons = [] if mode == "polygons" else None
+    collectors = []
+    for n, key in enumerate(keys):
+        terms = []
+        if key in layers_a:
+            tp.input("a%d" % n, layout_a, cell_a.cell_index(), layers_a[key])
+            terms.append("a%d" % n)
+        if key in layers_b:
+            tp.input("b%d" % n, layout_b, cell_b.cell_index(), layers_b[key])
+            terms.append("b%d" % n)
+        collector = _RegionCollector("%s/%s" % key, polygons, MAX_RESULT_ITEMS)
+        collectors.append(collector)
+        tp.output("o%d" % n, collector)
+        tp.queue("_output(o%d, %s, true)" % (n, " ^ ".join(terms)))
+    if collectors:
+        tp.execute("diff_layouts")
+
+    if mode == "polygons":
+        items = polygons
+    else:
+        items = [entry for collector in collectors for entry in collector.tiles]
+    token = _RESULTS.store(items, params.get("page_size", RESULT_PAGE_SIZE))
+    result = {
+        "identical": all(c.count == 0 for c in collectors),
+        "dbu": layout_a.dbu,
+        "tile_um": tile,
+        "threads": threads,
+        "mode": mode,
+        "truncated": any(c.truncated for c in collectors),
+        "layers": [
+            {"layer": c.layer, "count": c.count, "area": c.area}
+            for c in collectors
+            if c.count
+        ],
+    }
+    result.update(_RESULTS.page(token, 0))
+    return result
+
+
+def _edge_pair_coords(pair):
+    first = pair.first
+    second = pair.second
+    return [
+        first.p1.x, first.p1.y, first.p2.x, first.p2.y,
+        second.p1.x, second.p1.y, second.p2.x, second.p2.y,
+    ]
+
+
+def _check_rules(params):
+    """Run width/space/enclosure/area checks on deep (hierarchical) regions.
+
+    params: layout (path / cellview index, default active), cell, rules
+    (list of {"rule": "width"|"space"|"area"|"enclosure", "layer": "L/D",
+    "value": microns or um^2, "inner": "L/D" for enclosure}), threads,
+    summary_only, page_size. Markers are paged like diff_layouts results.
+    """
+    layout, cell = _resolve_layout_ref(params.get("layout"), params.get("cell"))
+    rules = params.get("rules") or []
+    if not rules:
+        raise RuntimeError("rules is required")
+    summary_only = bool(params.get("summary_only"))
+    threads = int(params.get("threads") or os.cpu_count() or 1)
+    dbu = layout.dbu
+
+    dss = pya.DeepShapeStore()
+    dss.threads = threads
+    layers = _layer_indexes_by_info(layout)
+    regions = {}
+
+    def region(spec):
+        key = _parse_layer_spec(spec)
+        if key not in regions:
+            index = layers.get(key)
+            if index is None:
+                raise RuntimeError("Layer not found: %s" % spec)
+            regions[key] = pya.Region(cell.begin_shapes_rec(index), dss)
+        return regions[key]
+
+    summary = []
+    markers = []
+    truncated = False
+    for rule in rules:
+        kind = rule.get("rule")
+        layer = rule.get("layer")
+        value = float(rule.get("value", 0))
+        if kind == "width":
+            found = region(layer).width_check(int(round(value / dbu)))
+        elif kind == "space":
+            found = region(layer).space_check(int(round(value / dbu)))
+        elif kind == "enclosure":
+            if not rule.get("inner"):
+                raise RuntimeError("enclosure rule needs 'inner'")
+            found = region(layer).enclosing_check(region(rule["inner"]), int(round(value / dbu)))
+        elif kind == "area":
+            limit = int(round(value / (dbu * dbu)))
+            found = region(layer).merged().with_area(0, limit, False)
+        else:
+            raise RuntimeError("Unknown rule: %s" % kind)
+        count = found.count()
+        summary.append({"rule": kind, "layer": layer, "value": value, "violations": count})
+        if summary_only or not count or truncated:
+            continue
+        found.flatten()
+        for item in found.each():
+            if len(markers) >= MAX_RESULT_ITEMS:
+                truncated = True
+                break
+            marker = {"rule": kind, "layer": layer}
+            if kind == "area":
+                marker["hull"] = _polygon_hull(item)
+            else:
+                marker["edges"] = _edge_pair_coords(item)
+            markers.append(marker)
+
+    result = {
+        "cell": cell.name,
+        "dbu": dbu,
+        "threads": threads,
+        "violations": sum(entry["violations"] for entry in summary),
+        "summary": summary,
+        "truncated": truncated,
+    }
+    if not summary_only:
+        token = _RESULTS.store(markers, params.get("page_size", RESULT_PAGE_SIZE))
+        result.update(_RESULTS.page(token, 0))
+    return result
+
+
+class _DensityCollector(pya.TileOutputReceiver):
+    """Stores the coverage ratio of each tile into a row-major float32 grid."""
+
+    def __init__(self, values, offset, nx):
+        self.values = values
+        self.offset = offset
+        self.nx = nx
+
+    def put(self, ix, iy, tile, obj, dbu, clip):
+        self.values[self.offset + iy * self.nx + ix] = obj
+
+
+class _DensityMaps(object):
+    """Density grids of the current layout generation."""
+
+    def __init__(self, max_entries=DENSITY_CACHE_SIZE):
+        self.generation = None
+        self._maps = _LruCache(max_entries)
+
+    def get(self, key):
+        generation = _GENERATION.current()
+        if generation != self.generation:
+            self.generation = generation
+            self._maps.clear()
+        return self._maps.get(key)
+
+    def put(self, key, values):
+        self._maps.put(key, values)
+
+
+_DENSITY_MAPS = _DensityMaps()
+
+
+def _density_map(params):
+    """Per-tile coverage ratio over a window, as a packed float32 grid.
+
+    params: cell (default: active cell), layers (["1/0", ...], default: all;
+    their union unless per_layer), window [x1, y1, x2, y2] in microns
+    (default: cell bbox, grown to whole tiles), tile_um, threads, shm.
+    The grid has shape [ny, nx] ([layers, ny, nx] with per_layer), row 0 at
+    the bottom; "data" is base64 little-endian float32, or with "shm": true
+    the grid is handed over as a shared buffer (native byte order).
+    """
+    layout = _require_layout()
+    if params.get("cell"):
+        cell = layout.cell(params["cell"])
+        if cell is None:
+            raise RuntimeError("Cell not found: %s" % params["cell"])
+    else:
+        cell = _require_view().active_cellview().cell
+    by_info = _layer_indexes_by_info(layout)
+    if params.get("layers"):
+        keys = [_parse_layer_spec(spec) for spec in params["layers"]]
+        missing = ["%s/%s" % key for key in keys if key not in by_info]
+        if missing:
+            raise RuntimeError("Layer not found: %s" % ", ".join(missing))
+    else:
+        keys = sorted(by_info)
+    per_layer = bool(params.get("per_layer"))
+    tile = float(params.get("tile_um", DENSITY_TILE_MICRONS))
+    if tile <= 0:
+        raise RuntimeError("tile_um must be positive")
+    window = pya.DBox(*params["window"]) if params.get("window") else cell.dbbox()
+    if window.empty() or window.width() <= 0 or window.height() <= 0:
+        raise RuntimeError("Empty window")
+    nx = max(int(math.ceil(window.width() / tile - 1e-9)), 1)
+    ny = max(int(math.ceil(window.height() / tile - 1e-9)), 1)
+    planes = len(keys) if per_layer else 1
+    if nx * ny * planes > DENSITY_MAX_TILES:
+        raise RuntimeError(
+            "%d x %d tiles exceed %d; use a larger tile_um" % (nx, ny, DENSITY_MAX_TILES)
+        )
+    # Whole tiles from the lower left corner: with a fixed tile count the
+    # processor centers the grid on the frame, which then lines up exactly.
+    frame = pya.DBox(window.left, window.bottom, window.left + nx * tile, window.bottom + ny * tile)
+
+    start = time.perf_counter()
+    cache_key = (cell.cell_index(), tuple(keys), per_layer, tile, frame.left, frame.bottom, nx, ny)
+    values = _DENSITY_MAPS.get(cache_key)
+    cached = values is not None
+    threads = 0
+    if not cached:
+        values = array.array("f", bytes(4 * nx * ny * planes))
+        if keys:
+            tp, _, threads = _tiling_processor(layout.dbu, dict(params, tile_um=tile))
+            tp.frame = frame
+            tp.tiles(nx, ny)
+            for n, key in enumerate(keys):
+                tp.input("l%d" % n, layout, cell.cell_index(), by_info[key])
+            if per_layer:
+                groups = [["l%d" % n] for n in range(len(keys))]
+            else:
+                groups = [["l%d" % n for n in range(len(keys))]]
+            collectors = []
+            for n, names in enumerate(groups):
+                collector = _DensityCollector(values, n * nx * ny, nx)
+                collectors.append(collector)
+                tp.output("o%d" % n, collector)
+                tp.queue(
+                    "_output(o%d, to_f((%s).area(_tile.bbox)) / to_f(_tile.bbox.area))"
+                    % (n, " + ".join(names))
+                )
+            tp.execute("density_map")
+        _DENSITY_MAPS.put(cache_key, values)
+
+    shape = [planes, ny, nx] if per_layer else [ny, nx]
+    result = {
+        "cell": cell.name,
+        "layers": ["%s/%s" % key for key in keys],
+        "per_layer": per_layer,
+        "window": [frame.left, frame.bottom, frame.right, frame.top],
+        "tile_um": tile,
+        "dtype": "float32",
+        "shape": shape,
+        "generation": _DENSITY_MAPS.generation,
+        "cached": cached,
+        "threads": threads,
+        "elapsed_ms": round((time.perf_counter() - start) * 1000.0, 3),
+    }
+    if params.get("shm"):
+        result["shared"] = _SHARED_BUFFERS.publish([("density", values, shape)])
+    else:
+        if sys.byteorder != "little":
+            values = array.array("f", values)
+            values.byteswap()
+        result["data"] = base64.b64encode(values.tobytes()).decode("ascii")
+    return result
+
+
+_SNAPSHOT_IMAGES = _LruCache(
+    max(SNAPSHOT_CACHE_SIZE // 4, 1),
+    max_bytes=SNAPSHOT_IMAGE_CACHE_BYTES,
+    sizeof=lambda image: image.width() * image.height() * 4,
+)
+_SNAPSHOT_BYTES = _LruCache(SNAPSHOT_CACHE_SIZE)
+
+
+def _layer_refs(view):
+    refs = []
+    it = view.begin_layers()
+    while not it.at_end():
+        refs.append(it.current())
+        it.next()
+    return refs
+
+
+def _visible_layer_signature(view):
+    return tuple((ref.source, ref.visible) for ref in _layer_refs(view))
+
+
+def _render_view_signature(view):
+    """Display state that changes a render without changing the layout."""
+    styles = tuple(
+        (
+            ref.source,
+            ref.eff_fill_color(True),
+            ref.eff_frame_color(True),
+            ref.eff_dither_pattern(True),
+            ref.eff_line_style(True),
+            ref.fill_brightness,
+            ref.frame_brightness,
+            ref.width,
+            ref.transparent,
+            ref.xfill,
+            ref.marked,
+            ref.animation,
+            ref.lower_hier_level if ref.has_lower_hier_level() else None,
+            ref.upper_hier_level if ref.has_upper_hier_level() else None,
+        )
+        for ref in _layer_refs(view)
+    )
+    return (view.min_hier_levels, view.max_hier_levels, styles)
+
+
+def _render_with_layers(view, specs, render):
+    """Render with only the given layers visible, then restore visibility."""
+    if not specs:
+        return render()
+    wanted = set(_parse_layer_spec(spec) for spec in specs)
+    saved = []
+    for ref in _layer_refs(view):
+        visible = (ref.source_layer, ref.source_datatype) in wanted
+        saved.append((ref, ref.visible))
+        if ref.visible != visible:
+            ref.visible = visible
+    try:
+        return render()
+    finally:
+        for ref, visible in saved:
+            if ref.visible != visible:
+                ref.visible = visible
+
+
+def _encode_image(image, fmt, quality):
+    buffer = pya.QBuffer()
+    buffer.open(pya.QIODevice.WriteOnly)
+    image.save(buffer, fmt, quality)
+    data = bytes(buffer.data())
+    buffer.close()
+    return data
+
+
+def _snapshot(params):
+    """Render a bbox (microns, default: visible area) to PNG/JPEG bytes.
+
+    Rendered images and encoded bytes are cached by layout generation,
+    layer visibility and display styles, hierarchy levels, bbox and size;
+    rendered images are also capped by SNAPSHOT_IMAGE_CACHE_BYTES; thumbnails are downscaled from the
+    cached render instead of rendering again.
+    """
+    view = _require_view()
+    fmt = str(params.get("format", "png")).lower()
+    if fmt not in ("png", "jpeg", "jpg"):
+        raise RuntimeError("format must be png or jpeg")
+    width = min(max(int(params.get("width", 800)), 1), SNAPSHOT_MAX_PIXELS)
+    height = min(max(int(params.get("height", 600)), 1), SNAPSHOT_MAX_PIXELS)
+    quality = int(params.get("quality", 85))
+    thumbnail = params.get("thumbnail") or 0
+    if thumbnail is True:
+        thumbnail = SNAPSHOT_THUMBNAIL
+    thumbnail = int(thumbnail)
+    layers = tuple(params.get("layers") or ())
+    box = pya.DBox(*params["bbox"]) if params.get("bbox") else view.box()
+
+    render_key = (
+        _GENERATION.current(),
+        layers or _visible_layer_signature(view),
+        _render_view_signature(view),
+        (box.left, box.bottom, box.right, box.top),
+        width,
+        height,
+    )
+    encode_key = render_key + (fmt, quality, thumbnail)
+    entry = _SNAPSHOT_BYTES.get(encode_key)
+    cached = entry is not None
+    if entry is None:
+        image = _SNAPSHOT_IMAGES.get(render_key)
+        if image is None:
+            image = _render_with_layers(
+                view,
+                layers,
+                lambda: view.get_image_with_options(width, height, 0, 1, 0, box, False),
+            )
+            _SNAPSHOT_IMAGES.put(render_key, image)
+        if thumbnail:
+            image = image.scaled(
+                thumbnail, thumbnail, pya.Qt.KeepAspectRatio, pya.Qt.SmoothTransformation
+            )
+        data = _encode_image(image, "PNG" if fmt == "png" else "JPEG", quality)
+        entry = (data, image.width(), image.height())
+        _SNAPSHOT_BYTES.put(encode_key, entry)
+    data, out_width, out_height = entry
+    return {
+        "format": "png" if fmt == "png" else "jpeg",
+        "width": out_width,
+        "height": out_height,
+        "bbox": [box.left, box.bottom, box.right, box.top],
+        "cached": cached,
+        "data": base64.b64encode(data).decode("ascii"),
+    }
+
+
 def _selection_string_from_view(view):
     selection = view.object_selection
     if not selection:
@@ -307,13 +2115,16 @@ def _selection_string_from_view(view):
             continue
         layer_info = layout.get_info(layer_index)
         layer_str = "%s/%s" % (layer_info.layer, layer_info.datatype)
+        return _polygon_string(layer_str, poly)
+    return None
 
-        coords = []
-        for pt in poly.each_point_hull():
-            coords.append("%s_%s" % (pt.x, pt.y))
 
-        return layer_str + "@" + "_".join(coords)
-    return None
+def _polygon_string(layer_str, poly):
+    """Selection-event format: ``L/D@x1_y1_x2_y2_...`` (hull, database units)."""
+    coords = []
+    for pt in poly.each_point_hull():
+        coords.append("%s_%s" % (pt.x, pt.y))
+    return layer_str + "@" + "_".join(coords)
 
 
 def _get_selected_polygon_string():
@@ -321,5 +2132,38 @@ def _get_selected_polygon_string():
     return _selection_string_from_view(view)
 
 
-SERVER = _JsonTcpServer()
-SERVER.start()
+# Connection-independent handlers, shared by the TCP dispatcher and by
+# in-process callers such as the dock chat (macro_chat_gui.py).
+_TOOL_HANDLERS = {
+    "open_layout": _open_layout,
+    "load_gds": _load_gds,
+    "get_cell_list": _get_cell_list,
+    "export_gds": _export_gds,
+    "layout_generation": _layout_generation,
+    "diff_layouts": _diff_layouts,
+    "fetch_page": _fetch_page,
+    "check_rules": _check_rules,
+    "snapshot": _snapshot,
+    "cell_tree": _cell_tree,
+    "pick": _pick,
+    "shapes_touching": _shapes_touching,
+    "layer_polygons": _layer_polygons,
+    "release_buffer": _release_buffer,
+    "density_map": _density_map,
+}
+
+
+def call_tool(method, params=None):
+    handler = _TOOL_HANDLERS.get(method)
+    if handler is None:
+        raise RuntimeError("Unknown method: %s" % method)
+    return handler(params or {})
+
+
+if __name__ == "__main__":
+    # macro_chat_gui calls the tools in-process; register this instance so it
+    # shares the running server's generation, caches and shared buffers
+    # instead of importing a second copy of the module.
+    sys.modules["macro_klayout_tcp_server"] = sys.modules[__name__]
+    SERVER = _JsonTcpServer()
+    SERVER.start()
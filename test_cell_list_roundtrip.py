@@ -1,9 +1,9 @@
 import json
 import os
-import socket
 
 import httpx
 
+from klayout_client import KlayoutClient
 from llm_klayout_logger import (
     LLM_ENDPOINT,
     LLM_MODEL,
@@ -14,29 +14,11 @@ from llm_klayout_logger import (
 
 KLAYOUT_HOST = "127.0.0.1"
 KLAYOUT_PORT = 9009
+KLAYOUT_SOCKET_PATH = os.environ.get("KLAYOUT_LOCAL_SOCKET")
 
 
-def _send_klayout(payload):
-    sock = socket.create_connection((KLAYOUT_HOST, KLAYOUT_PORT), timeout=5)
-    try:
-        line = json.dumps(payload).encode("utf-8") + b"\n"
-        sock.sendall(line)
-        data = b""
-        while b"\n" not in data:
-            chunk = sock.recv(4096)
-            if not chunk:
-                break
-            data += chunk
-        if not data:
-            raise RuntimeError("No response from KLayout")
-        return json.loads(data.split(b"\n", 1)[0].decode("utf-8"))
-    finally:
-        sock.close()
-
-
-def _open_layout(path):
-    payload = {"id": 1, "method": "open_layout", "params": {"path": path}}
-    return _send_klayout(payload)
+def _open_layout(client, path):
+    return client.request("open_layout", {"path": path})
 
 
 def _call_llm_stream(messages):
@@ -81,7 +63,8 @@ def _call_llm_complete(messages):
 def main():
     root = os.path.dirname(os.path.abspath(__file__))
     gds_path = os.path.join(root, "test.gds")
-    _open_layout(gds_path)
+    client = KlayoutClient(KLAYOUT_HOST, KLAYOUT_PORT, timeout=5, path=KLAYOUT_SOCKET_PATH)
+    _open_layout(client, gds_path)
 
     tool_prompt = (
         "Return ONLY this JSON tool block on its own line: "
@@ -96,13 +79,8 @@ def main():
     if not command:
         raise RuntimeError("No tool command returned by model")
 
-    response = _send_klayout(
-        {
-            "id": command.get("id", 2),
-            "method": command["method"],
-            "params": command.get("params", {}),
-        }
-    )
+    response = client.request(command["method"], command.get("params", {}))
+    client.close()
     if not response.get("ok"):
         raise RuntimeError("KLayout error: %s" % response.get("error"))
 
@@ -0,0 +1,128 @@
+import ast
+import os
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# The chat macro builds Qt widgets on import, so only the pure-Python
+# context helpers are loaded from its source.
+HELPERS = {
+    "CONTEXT_TOKEN_BUDGET",
+    "SUMMARY_TOKEN_BUDGET",
+    "SUMMARY_SNIPPET_CHARS",
+    "IMAGE_TOKEN_ESTIMATE",
+    "_content_text",
+    "_estimate_tokens",
+    "_ContextWindow",
+}
+
+
+def _load_helpers():
+    path = os.path.join(ROOT, "macro_chat_gui.py")
+    with open(path, "r", encoding="utf-8") as handle:
+        tree = ast.parse(handle.read(), path)
+    body = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in HELPERS:
+            body.append(node)
+        elif isinstance(node, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id in HELPERS for target in node.targets
+        ):
+            body.append(node)
+    namespace = {}
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, "exec"), namespace)
+    missing = HELPERS - set(namespace)
+    assert not missing, "macro_chat_gui.py no longer defines %s" % sorted(missing)
+    return namespace
+
+
+chat = _load_helpers()
+SYSTEM = "You are a layout assistant."
+
+
+def _tokens(messages):
+    return sum(chat["_estimate_tokens"](chat["_content_text"](m["content"])) for m in messages)
+
+
+def test_context_under_budget_is_verbatim():
+    window = chat["_ContextWindow"](token_budget=1000, summary_budget=100)
+    window.append("user", "hello")
+    window.append("assistant", "hi there")
+    assert window.build(SYSTEM) == [
+        {"role": "system", "content": SYSTEM},
+        {"role": "user", "content": "hello"},
+        {"role": "assistant", "content": "hi there"},
+    ]
+
+
+def test_context_evicts_oldest_turns_into_summary():
+    window = chat["_ContextWindow"](token_budget=200, summary_budget=70)
+    for n in range(10):
+        window.append("user" if n % 2 == 0 else "assistant", "turn %d %s" % (n, "x" * 80))
+    messages = window.build(SYSTEM)
+    summary = messages[1]
+    assert summary["role"] == "system" and summary["content"].startswith("先前對話摘要")
+    kept = [int(m["content"].split()[1]) for m in messages[2:]]
+    # The most recent turns survive verbatim; the summary holds the turns
+    # folded last, directly before them.
+    assert 1 < len(kept) < 10 and kept == list(range(10 - len(kept), 10)), kept
+    lines = summary["content"].splitlines()[1:]
+    folded = [int(line.split()[3]) for line in lines]
+    assert folded and folded == list(range(kept[0] - len(folded), kept[0])), folded
+    estimate = chat["_estimate_tokens"]
+    used = estimate(SYSTEM) + sum(estimate(line) for line in lines) + _tokens(messages[2:])
+    assert used <= 200, used
+
+
+def test_context_keeps_newest_turn_over_budget():
+    window = chat["_ContextWindow"](token_budget=10, summary_budget=1000)
+    window.append("user", "short")
+    window.append("user", "y" * 400)
+    messages = window.build(SYSTEM)
+    assert messages[-1] == {"role": "user", "content": "y" * 400}
+    assert len([m for m in messages if m["role"] == "user"]) == 1
+
+
+def test_context_summary_budget_and_snippets():
+    snippet = chat["SUMMARY_SNIPPET_CHARS"]
+    window = chat["_ContextWindow"](token_budget=1, summary_budget=120)
+    for n in range(20):
+        window.append("user", "message %d %s" % (n, "z" * (2 * snippet)))
+    messages = window.build(SYSTEM)
+    lines = messages[1]["content"].splitlines()[1:]
+    # Oldest summary lines are dropped first; each one is clipped.
+    assert lines[-1].startswith("- user: message 18 ")
+    assert "message 0 " not in messages[1]["content"]
+    assert all(len(line) <= len("- user: ") + snippet + 1 for line in lines)
+    assert all(line.endswith("…") for line in lines)
+    assert sum(chat["_estimate_tokens"](line) for line in lines) <= 120
+
+
+def test_context_counts_images_and_clears():
+    window = chat["_ContextWindow"](token_budget=chat["IMAGE_TOKEN_ESTIMATE"], summary_budget=100)
+    window.append("user", "before")
+    window.append(
+        "user",
+        [
+            {"type": "text", "text": "what is this?"},
+            {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}},
+        ],
+    )
+    messages = window.build(SYSTEM)
+    # The image alone fills the budget, so the earlier turn is summarised.
+    assert "before" in messages[1]["content"]
+    assert messages[-1]["content"][0]["text"] == "what is this?"
+    window.clear()
+    assert window.build(SYSTEM) == [{"role": "system", "content": SYSTEM}]
+
+
+def main():
+    test_context_under_budget_is_verbatim()
+    test_context_evicts_oldest_turns_into_summary()
+    test_context_keeps_newest_turn_over_budget()
+    test_context_summary_budget_and_snippets()
+    test_context_counts_images_and_clears()
+    print("PASS: chat context window")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import os
+import struct
+import sys
+import tempfile
+
+from klayout_client import KlayoutClient
+
+
+HOST = "127.0.0.1"
+PORT = 9009
+SOCKET_PATH = os.environ.get("KLAYOUT_LOCAL_SOCKET")
+
+
+def _record(kind, datatype, payload=b""):
+    return struct.pack(">HBB", 4 + len(payload), kind, datatype) + payload
+
+
+def _write_gds(path, boxes):
+    """Write a one-cell GDS (dbu 1 nm) with rectangles (layer, x1, y1, x2, y2) in nm."""
+    stamp = struct.pack(">12h", *([0] * 12))
+    units = bytes.fromhex("3E4189374BC6A7EF") + bytes.fromhex("3944B82FA09B5A54")
+    data = _record(0x00, 0x02, struct.pack(">h", 600))
+    data += _record(0x01, 0x02, stamp) + _record(0x02, 0x06, b"DIFF")
+    data += _record(0x03, 0x05, units)
+    data += _record(0x05, 0x02, stamp) + _record(0x06, 0x06, b"TOP\0")
+    for layer, x1, y1, x2, y2 in boxes:
+        points = [x1, y1, x1, y2, x2, y2, x2, y1, x1, y1]
+        data += _record(0x08, 0x00)
+        data += _record(0x0D, 0x02, struct.pack(">h", layer))
+        data += _record(0x0E, 0x02, struct.pack(">h", 0))
+        data += _record(0x10, 0x03, struct.pack(">10i", *points))
+        data += _record(0x11, 0x00)
+    data += _record(0x07, 0x00) + _record(0x04, 0x00)
+    with open(path, "wb") as handle:
+        handle.write(data)
+
+
+def main():
+    tmp = tempfile.mkdtemp(prefix="diff_layouts_")
+    a_path = os.path.join(tmp, "a.gds")
+    b_path = os.path.join(tmp, "b.gds")
+    # Both layouts fit into a single default tile; b's second box is 2 um shorter.
+    _write_gds(a_path, [(1, 0, 0, 10000, 10000), (1, 20000, 0, 30000, 10000)])
+    _write_gds(b_path, [(1, 0, 0, 10000, 10000), (1, 22000, 0, 30000, 10000)])
+
+    with KlayoutClient(HOST, PORT, timeout=30, path=SOCKET_PATH) as client:
+        same = client.request("diff_layouts", {"a": a_path, "b": a_path})
+        print("Same:", same)
+        assert same["ok"] and same["result"]["identical"], same
+
+        diff = client.request("diff_layouts", {"a": a_path, "b": b_path})
+        print("Summary:", diff)
+        assert diff["ok"], diff
+        result = diff["result"]
+        assert not result["identical"], result
+        assert result["layers"] == [{"layer": "1/0", "count": 1, "area": 20000000}], result
+
+        polygons = client.request("diff_layouts", {"a": a_path, "b": b_path, "mode": "polygons"})
+        print("Polygons:", polygons)
+        assert polygons["ok"], polygons
+        assert len(polygons["result"]["items"]) == 1, polygons
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except Exception as exc:
+        print("ERROR:", exc)
+        sys.exit(1)
@@ -1,8 +1,12 @@
+import asyncio
 import json
 import os
+import tempfile
 
+from llm_cassette import CassettePlayer, CassetteRecorder, RecordingKlayoutClient
 from llm_klayout_logger import (
     AppLogger,
+    _ToolCallAssembler,
     _extract_content_from_event,
     _extract_klayout_commands,
     _send_klayout_command,
@@ -25,6 +29,140 @@ def _fake_sse_lines():
     yield "data: [DONE]"
 
 
+def _tool_delta(index, name=None, arguments=None, finish_reason=None):
+    function = {}
+    if name:
+        function["name"] = name
+    if arguments:
+        function["arguments"] = arguments
+    return {
+        "choices": [
+            {
+                "delta": {"tool_calls": [{"index": index, "function": function}]},
+                "finish_reason": finish_reason,
+            }
+        ]
+    }
+
+
+def test_tool_call_assembler_fragments():
+    assembler = _ToolCallAssembler()
+    fragments = ['{"met', 'hod": "pick", ', '"params": {"x": 1.5,', ' "y": 2}}']
+    assert assembler.feed(_tool_delta(0, name="klayout")) == []
+    for fragment in fragments:
+        # Interleave a second call so arguments must be kept apart per index.
+        assert assembler.feed(_tool_delta(0, arguments=fragment)) == []
+        assert assembler.feed(_tool_delta(1, name="klayout", arguments=fragment)) == []
+    commands = assembler.feed({"choices": [{"delta": {}, "finish_reason": "tool_calls"}]})
+    expected = {"tool": "klayout", "method": "pick", "params": {"x": 1.5, "y": 2}}
+    assert commands == [expected, expected], commands
+    # The assembler starts over after a flush.
+    assert assembler.flush() == []
+
+
+def test_tool_call_assembler_ignores_other_calls():
+    assembler = _ToolCallAssembler()
+    assembler.feed(_tool_delta(0, name="web_search", arguments='{"method": "ping"}'))
+    assembler.feed(_tool_delta(1, name="klayout", arguments='{"method": "pi'))
+    assembler.feed(_tool_delta(2, name="klayout", arguments='{"params": {}}'))
+    assembler.feed(_tool_delta(3, name="klayout", arguments='{"method": "get_cell_list"}'))
+    commands = assembler.flush()
+    # Unknown tool, truncated JSON and a missing method are all dropped.
+    assert commands == [{"tool": "klayout", "method": "get_cell_list"}], commands
+
+
+def test_tool_call_assembler_complete_message():
+    assembler = _ToolCallAssembler()
+    message = {
+        "choices": [
+            {
+                "message": {
+                    "tool_calls": [
+                        {"function": {"name": "klayout", "arguments": '{"method": "ping"}'}},
+                        {"function": {"name": "klayout", "arguments": ""}},
+                    ]
+                }
+            }
+        ]
+    }
+    assert assembler.feed(message) == [{"tool": "klayout", "method": "ping"}]
+
+
+class _FakeKlayout:
+    def __init__(self):
+        self.calls = 0
+
+    async def request(self, method, params=None, timeout=None, trace=None):
+        self.calls += 1
+        return {"id": self.calls, "ok": True, "result": {"method": method, "call": self.calls}}
+
+
+async def _chunks(items, fail=False):
+    for item in items:
+        yield item
+    if fail:
+        raise ConnectionError("upstream went away")
+
+
+async def _collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+async def _record_and_replay(path):
+    recorder = CassetteRecorder(path)
+    stream = [b"data: {\"a\": 1}\n\n", b"data: [DONE]\n\n"]
+    assert await _collect(recorder.record_stream(_chunks(stream))) == stream
+    try:
+        await _collect(recorder.record_stream(_chunks([b"data: partial"], fail=True)))
+    except ConnectionError:
+        pass
+    client = RecordingKlayoutClient(_FakeKlayout(), recorder)
+    await client.request("get_cell_list", {})
+    await client.request("pick", {"x": 1, "y": 2})
+    await client.request("pick", {"y": 2, "x": 1})
+    await client.request("pick", {"x": 5, "y": 5})
+
+    with open(path, "r", encoding="utf-8") as handle:
+        records = [json.loads(line) for line in handle]
+    assert [record.get("complete") for record in records[:2]] == [True, False]
+
+    player = CassettePlayer(path, speed=0)
+    # Streams come back byte for byte, in recorded order, wrapping around.
+    assert await _collect(player.stream()) == stream
+    assert await _collect(player.stream()) == [b"data: partial"]
+    assert await _collect(player.stream()) == stream
+    # Replies match on method + params (key order ignored), cycling per key.
+    first = await player.request("pick", {"y": 2, "x": 1})
+    second = await player.request("pick", {"x": 1, "y": 2})
+    third = await player.request("pick", {"x": 1, "y": 2})
+    assert [first["result"]["call"], second["result"]["call"], third["result"]["call"]] == [2, 3, 2]
+    # Unknown params fall back to the last reply recorded for the method.
+    assert (await player.request("pick", {"x": 9}))["result"]["call"] == 4
+    missing = await player.request("export_gds", {})
+    assert not missing["ok"]
+    # Replies are copies; callers may mutate them freely.
+    reply = await player.request("get_cell_list")
+    assert reply["result"]["call"] == 1
+    reply["result"]["call"] = 99
+    assert (await player.request("get_cell_list"))["result"]["call"] == 1
+
+
+def test_cassette_record_and_replay():
+    with tempfile.TemporaryDirectory() as tmp:
+        asyncio.run(_record_and_replay(os.path.join(tmp, "cassette.jsonl")))
+
+
+def test_cassette_without_streams_is_rejected():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cassette.jsonl")
+        CassetteRecorder(path).record_klayout("ping", {}, {"ok": True}, 0.001)
+        try:
+            CassettePlayer(path)
+        except ValueError:
+            return
+        raise AssertionError("a cassette without LLM streams was accepted")
+
+
 def main():
     logger = AppLogger("llm_stream_sim.log")
     buffer_text = ""
@@ -48,4 +186,11 @@ def main():
 
 
 if __name__ == "__main__":
+    test_tool_call_assembler_fragments()
+    test_tool_call_assembler_ignores_other_calls()
+    test_tool_call_assembler_complete_message()
+    print("PASS: tool call assembler")
+    test_cassette_record_and_replay()
+    test_cassette_without_streams_is_rejected()
+    print("PASS: cassette record / replay")
     main()
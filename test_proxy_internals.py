@@ -0,0 +1,418 @@
+import asyncio
+import json
+import os
+import tempfile
+
+import httpx
+from fastapi.testclient import TestClient
+
+import llm_klayout_logger as proxy
+
+
+class _Logger:
+    def __init__(self):
+        self.lines = []
+
+    def log(self, message):
+        self.lines.append(message)
+
+    def log_bytes(self, data):
+        self.lines.append(data.decode("utf-8"))
+
+
+class _FakeKlayout:
+    """Answers like the server; the layout generation is set by the test."""
+
+    def __init__(self):
+        self.generation = 1
+        self.calls = []
+
+    async def request(self, method, params=None, timeout=None, trace=None):
+        if method == "layout_generation":
+            return {"id": 0, "ok": True, "result": {"generation": self.generation}}
+        self.calls.append(method)
+        await asyncio.sleep(0)
+        return {
+            "id": len(self.calls),
+            "ok": True,
+            "result": {"call": len(self.calls)},
+            "trace": {"span_id": "server-%d" % len(self.calls)},
+        }
+
+
+def _loader(reply, calls):
+    async def load():
+        calls.append(reply)
+        await asyncio.sleep(0)
+        return reply
+
+    return load
+
+
+async def _cache_hits_and_lru():
+    cache = proxy._KlayoutResultCache(max_entries=2, ttl=60.0)
+    calls = []
+    reply = {"ok": True, "result": 1, "trace": {"span_id": "s1"}}
+    first, shared = await cache.fetch("a", _loader(reply, calls))
+    assert first is reply and not shared
+    second, shared = await cache.fetch("a", _loader(reply, calls))
+    # Hits never carry the server timing of the call that filled the entry.
+    assert shared and second == {"ok": True, "result": 1}
+    await cache.fetch("b", _loader({"ok": True, "result": 2}, calls))
+    await cache.fetch("a", _loader(reply, calls))
+    await cache.fetch("c", _loader({"ok": True, "result": 3}, calls))
+    # "a" was used last, so "b" is the least recently used entry to go.
+    assert len(calls) == 3
+    await cache.fetch("a", _loader(reply, calls))
+    assert len(calls) == 3
+    await cache.fetch("b", _loader({"ok": True, "result": 2}, calls))
+    assert len(calls) == 4
+    cache.invalidate()
+    await cache.fetch("a", _loader(reply, calls))
+    assert len(calls) == 5
+
+
+async def _cache_skips_errors_expired_and_shared_memory():
+    calls = []
+    cache = proxy._KlayoutResultCache(ttl=60.0)
+    for reply in (
+        {"ok": False, "error": "No active view"},
+        {"ok": True, "result": {"shared": {"handle": "h1"}}},
+    ):
+        await cache.fetch("k", _loader(reply, calls))
+        await cache.fetch("k", _loader(reply, calls))
+    assert len(calls) == 4
+    expired = proxy._KlayoutResultCache(ttl=-1.0)
+    await expired.fetch("k", _loader({"ok": True}, calls))
+    await expired.fetch("k", _loader({"ok": True}, calls))
+    assert len(calls) == 6
+
+
+async def _cache_merges_inflight_calls():
+    cache = proxy._KlayoutResultCache()
+    calls = []
+    results = await asyncio.gather(
+        *(cache.fetch("k", _loader({"ok": True, "result": 7}, calls)) for _ in range(3))
+    )
+    assert len(calls) == 1
+    assert [shared for _, shared in results] == [False, True, True]
+
+    async def boom():
+        await asyncio.sleep(0)
+        raise ConnectionError("KLayout went away")
+
+    outcomes = await asyncio.gather(
+        cache.fetch("x", boom), cache.fetch("x", boom), return_exceptions=True
+    )
+    assert all(isinstance(outcome, ConnectionError) for outcome in outcomes), outcomes
+
+    # Cancelling the caller that is loading must not cancel merged callers;
+    # the next one in line loads the entry itself.
+    started = asyncio.Event()
+
+    async def slow():
+        started.set()
+        await asyncio.sleep(10)
+
+    first = asyncio.ensure_future(cache.fetch("y", slow))
+    await started.wait()
+    second = asyncio.ensure_future(cache.fetch("y", _loader({"ok": True, "result": 8}, calls)))
+    await asyncio.sleep(0)
+    first.cancel()
+    response, shared = await second
+    assert first.cancelled()
+    assert response["result"] == 8 and not shared
+    assert (await cache.fetch("y", slow)) == ({"ok": True, "result": 8}, True)
+
+
+async def _dispatch_survives_cancelled_merged_call():
+    fake = _FakeKlayout()
+    original = proxy._klayout
+    proxy._klayout = fake
+    proxy._klayout_cache.invalidate()
+    before = proxy._CANCELLATIONS["klayout_commands_cancelled"]
+    logger = _Logger()
+    try:
+        command = {"method": "get_cell_list", "params": {}}
+        first = asyncio.ensure_future(proxy._dispatch_klayout_commands([command], logger))
+        second = asyncio.ensure_future(proxy._dispatch_klayout_commands([command], logger))
+        await asyncio.sleep(0)
+        first.cancel()
+        await second
+        assert first.cancelled() and not second.cancelled()
+        assert proxy._CANCELLATIONS["klayout_commands_cancelled"] - before == 1
+        assert any(line.startswith("[KLAYOUT] response:") for line in logger.lines)
+    finally:
+        proxy._klayout = original
+        proxy._klayout_cache.invalidate()
+
+
+async def _dispatch_keys_on_generation():
+    fake = _FakeKlayout()
+    original = proxy._klayout
+    proxy._klayout = fake
+    proxy._klayout_cache.invalidate()
+    logger = _Logger()
+    try:
+        command = {"method": "get_cell_list", "params": {}}
+        await proxy._dispatch_klayout_command(command, logger)
+        await proxy._dispatch_klayout_command(command, logger)
+        assert fake.calls == ["get_cell_list"]
+        fake.generation = 2
+        await proxy._dispatch_klayout_command(command, logger)
+        assert fake.calls == ["get_cell_list"] * 2
+        await proxy._dispatch_klayout_command(
+            {"method": "pick", "params": {"x": 0, "y": 0, "shm": True}}, logger
+        )
+        await proxy._dispatch_klayout_command(
+            {"method": "pick", "params": {"x": 0, "y": 0, "shm": True}}, logger
+        )
+        await proxy._dispatch_klayout_command({"method": "load_gds", "params": {}}, logger)
+        await proxy._dispatch_klayout_command(command, logger)
+        assert fake.calls[2:] == ["pick", "pick", "load_gds", "get_cell_list"], fake.calls
+        assert sum("cache hit" in line for line in logger.lines) == 1
+    finally:
+        proxy._klayout = original
+        proxy._klayout_cache.invalidate()
+
+
+async def _gather_counts_only_unfinished_commands():
+    fake = _FakeKlayout()
+    original = proxy._klayout
+    proxy._klayout = fake
+    proxy._klayout_cache.invalidate()
+    gate = asyncio.Event()
+
+    async def request(method, params=None, timeout=None, trace=None):
+        if method == "pick":
+            await gate.wait()
+        return await _FakeKlayout.request(fake, method, params, timeout, trace)
+
+    fake.request = request
+    before = proxy._CANCELLATIONS["klayout_commands_cancelled"]
+    logger = _Logger()
+    try:
+        commands = [{"method": "get_cell_list"}, {"method": "cell_tree"}, {"method": "pick"}]
+        task = asyncio.ensure_future(proxy._dispatch_klayout_commands(commands, logger))
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert fake.calls == ["get_cell_list", "cell_tree"], fake.calls
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        # Two of the three concurrent commands had already finished.
+        assert proxy._CANCELLATIONS["klayout_commands_cancelled"] - before == 1
+    finally:
+        proxy._klayout = original
+        proxy._klayout_cache.invalidate()
+
+
+def test_stream_ends_when_a_tool_call_is_cancelled_internally():
+    # A CancelledError that does not come from a client disconnect must end
+    # the stream with an error rather than leave it hanging.
+    async def chunks(body, span):
+        yield b'data: {"choices": [{"delta": {"content": "{\\"tool\\": \\"klayout\\", '
+        yield b'\\"method\\": \\"ping\\"}"}}]}\n\n'
+        yield b"data: [DONE]\n\n"
+
+    async def dispatch(commands, span=None):
+        raise asyncio.CancelledError()
+
+    saved = proxy._upstream_chunks, proxy._dispatch, proxy.logger
+    proxy._upstream_chunks, proxy._dispatch, proxy.logger = chunks, dispatch, _Logger()
+    try:
+        client = TestClient(proxy.app)
+        try:
+            with client.stream("POST", "/chat/completions", json={"messages": []}) as response:
+                body = b"".join(response.iter_bytes())
+        except RuntimeError as exc:
+            assert "cancelled" in str(exc), exc
+        else:
+            raise AssertionError("stream finished without the error: %r" % body)
+    finally:
+        proxy._upstream_chunks, proxy._dispatch, proxy.logger = saved
+
+
+def test_result_cache_hits_and_lru():
+    asyncio.run(_cache_hits_and_lru())
+
+
+def test_result_cache_skips_errors_expired_and_shared_memory():
+    asyncio.run(_cache_skips_errors_expired_and_shared_memory())
+
+
+def test_result_cache_merges_inflight_calls():
+    asyncio.run(_cache_merges_inflight_calls())
+
+
+def test_dispatch_cache_keys_on_generation():
+    asyncio.run(_dispatch_keys_on_generation())
+
+
+def test_dispatch_survives_cancelled_merged_call():
+    asyncio.run(_dispatch_survives_cancelled_merged_call())
+
+
+def test_dispatch_counts_only_unfinished_commands():
+    asyncio.run(_gather_counts_only_unfinished_commands())
+
+
+def _pool(*weights):
+    return proxy._UpstreamPool([
+        proxy._Upstream("http://u%d/v1/chat/completions" % n, weight)
+        for n, weight in enumerate(weights)
+    ])
+
+
+def test_upstream_pool_least_outstanding_by_weight():
+    pool = _pool(2, 1)
+    heavy, light = pool.upstreams
+    picked = [pool.acquire() for _ in range(6)]
+    # Twice the weight takes twice the concurrent requests.
+    assert picked.count(heavy) == 4 and picked.count(light) == 2, picked
+    assert (heavy.outstanding, light.outstanding) == (4, 2)
+    for upstream in picked:
+        pool.release(upstream)
+    assert (heavy.outstanding, light.outstanding) == (0, 0)
+    # Retries skip upstreams already tried for the request.
+    first = pool.acquire()
+    second = pool.acquire(exclude=[first])
+    assert second is not first
+    assert pool.acquire(exclude=[first, second]) is None
+
+
+def test_upstream_pool_ejection():
+    pool = _pool(1, 1)
+    bad, good = pool.upstreams
+    for _ in range(proxy.UPSTREAM_MAX_FAILURES - 1):
+        pool.failed(bad)
+    assert bad.ejected_until == 0.0
+    pool.failed(bad)
+    assert bad.ejected_until > 0.0
+    picked = [pool.acquire() for _ in range(3)]
+    assert picked == [good] * 3
+    # With every upstream ejected one is still tried rather than failing.
+    for _ in range(proxy.UPSTREAM_MAX_FAILURES):
+        pool.failed(good)
+    assert pool.acquire() in (bad, good)
+    # A success (request or health check) lets an upstream back in at once.
+    pool.succeeded(bad)
+    assert (bad.failures, bad.ejected_until) == (0, 0.0)
+    assert pool.acquire() is bad
+
+
+def test_upstream_pool_config():
+    entries = [
+        {"url": "http://box1:1234/v1/chat/completions", "weight": 2,
+         "models": {proxy.LLM_MODEL: "qwen3-coder-30b-a3b"}},
+        {"url": "http://box2:1234/v1/chat/completions"},
+    ]
+    pool = proxy._UpstreamPool.from_config(json.dumps(entries))
+    first, second = pool.upstreams
+    assert first.weight == 2.0 and second.weight == 1.0
+    assert first.model_for(proxy.LLM_MODEL) == "qwen3-coder-30b-a3b"
+    assert second.model_for(proxy.LLM_MODEL) == proxy.LLM_MODEL
+    assert first.health_url == "http://box1:1234/v1/models"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "upstreams.json")
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump(entries, handle)
+        assert [u.url for u in proxy._UpstreamPool.from_config(path).upstreams] == [
+            entry["url"] for entry in entries
+        ]
+    default = proxy._UpstreamPool.from_config("")
+    assert [u.url for u in default.upstreams] == [proxy.LLM_ENDPOINT]
+
+
+async def _collect_upstream(pool, handler):
+    saved_pool, saved_client = proxy._upstreams, proxy.httpx.AsyncClient
+    transport = httpx.MockTransport(handler)
+    proxy._upstreams = pool
+    proxy.httpx.AsyncClient = lambda **kwargs: saved_client(transport=transport, **kwargs)
+    try:
+        span = proxy._Span("test")
+        return b"".join([chunk async for chunk in proxy._upstream_chunks({}, span)]), span
+    finally:
+        proxy._upstreams, proxy.httpx.AsyncClient = saved_pool, saved_client
+
+
+def test_upstream_5xx_counts_as_failure():
+    def handler(request):
+        if request.url.host == "u0":
+            return httpx.Response(503, content=b"busy")
+        return httpx.Response(200, content=b"data: ok\n\n")
+
+    pool = _pool(1, 1)
+    first, second = pool.upstreams
+    body, span = asyncio.run(_collect_upstream(pool, handler))
+    # With another upstream left the 5xx is retried there.
+    assert body == b"data: ok\n\n" and span.attributes["llm.attempts"] == 2
+    assert (first.failures, second.failures) == (1, 0)
+    # The last upstream's 5xx reaches the client but still counts as a failure.
+    single = _pool(1)
+    body, _ = asyncio.run(_collect_upstream(single, handler))
+    assert body == b"busy"
+    assert single.upstreams[0].failures == 1
+    assert single.upstreams[0].outstanding == 0
+
+
+class _StalledWriter:
+    """Stands in for the sidecar stream; the test sets how much is unsent."""
+
+    def __init__(self):
+        self.lines = []
+        self.transport = self
+        self.buffered = 0
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def is_closing(self):
+        return False
+
+    def write(self, line):
+        self.lines.append(json.loads(line))
+
+
+def test_sidecar_drops_log_lines_while_behind():
+    client = proxy._SidecarClient("unused.sock")
+    writer = client._writer = _StalledWriter()
+    client.log("first")
+    writer.buffered = proxy.SIDECAR_WRITE_BUFFER_BYTES
+    client.log("lost")
+    client.log_bytes(b"lost too")
+    # Commands still go out; the worker is waiting for their replies.
+    client._send({"op": "cancel", "id": 1})
+    assert client.backlog_dropped == 2
+    writer.buffered = 0
+    client.log("after")
+    assert [line.get("text") for line in writer.lines] == [
+        "first",
+        None,
+        "[SIDECAR] dropped 2 log lines while the sidecar was unreachable or behind",
+        "after",
+    ], writer.lines
+    assert client.backlog_dropped == 0
+
+
+def main():
+    test_result_cache_hits_and_lru()
+    test_result_cache_skips_errors_expired_and_shared_memory()
+    test_result_cache_merges_inflight_calls()
+    test_dispatch_cache_keys_on_generation()
+    test_dispatch_survives_cancelled_merged_call()
+    test_dispatch_counts_only_unfinished_commands()
+    test_stream_ends_when_a_tool_call_is_cancelled_internally()
+    print("PASS: KLayout result cache")
+    test_upstream_pool_least_outstanding_by_weight()
+    test_upstream_pool_ejection()
+    test_upstream_pool_config()
+    test_upstream_5xx_counts_as_failure()
+    test_sidecar_drops_log_lines_while_behind()
+    print("PASS: upstream pool")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,12 @@
-import json
 import os
-import socket
 import sys
 
+from klayout_client import KlayoutClient
+
 
 HOST = "127.0.0.1"
 PORT = 9009
-
-
-def _send(sock, payload):
-    line = json.dumps(payload).encode("utf-8") + b"\n"
-    sock.sendall(line)
-    data = b""
-    while b"\n" not in data:
-        chunk = sock.recv(4096)
-        if not chunk:
-            break
-        data += chunk
-    if not data:
-        raise RuntimeError("No response from server")
-    return json.loads(data.split(b"\n", 1)[0].decode("utf-8"))
+SOCKET_PATH = os.environ.get("KLAYOUT_LOCAL_SOCKET")
 
 
 def main():
@@ -30,24 +17,15 @@ def main():
     if not os.path.exists(gds_path):
         raise RuntimeError("Missing test.gds at %s" % gds_path)
 
-    sock = socket.create_connection((HOST, PORT), timeout=5)
-    try:
-        print("Ping:", _send(sock, {"id": 1, "method": "ping"}))
-        print(
-            "Open layout:",
-            _send(
-                sock, {"id": 2, "method": "open_layout", "params": {"path": gds_path}}
-            ),
-        )
-        print("Cell list:", _send(sock, {"id": 3, "method": "get_cell_list"}))
+    with KlayoutClient(HOST, PORT, timeout=5, path=SOCKET_PATH) as client:
+        print("Ping:", client.request("ping"))
+        print("Open layout:", client.request("open_layout", {"path": gds_path}))
+        print("Cell list:", client.request("get_cell_list"))
+        print("Export:", client.request("export_gds", {"path": out_path}))
         print(
-            "Export:",
-            _send(
-                sock, {"id": 4, "method": "export_gds", "params": {"path": out_path}}
-            ),
+            "Pipelined:",
+            client.pipeline([("ping", {}), ("layout_generation", {}), ("get_cell_list", {})]),
         )
-    finally:
-        sock.close()
 
 
 if __name__ == "__main__":